@@ -0,0 +1,242 @@
+# ./archive.py
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+from redis_client import get_redis
+from serialization import loads
+from config import (REDIS_STREAM_PREFIX, HISTORY_MAX_LEN, WORKER_ID, ARCHIVE_ENABLED, ARCHIVE_DIR, ARCHIVE_AFTER,
+                    ARCHIVE_INTERVAL, ARCHIVE_BATCH, ARCHIVE_SEGMENT_BYTES)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bố cục trên đĩa, mỗi phòng một thư mục ARCHIVE_DIR/{hex(roomId)}:
+# - "{n:06d}.seg": file segment chỉ ghi nối, gồm các block zlib; mỗi block là một lượt lưu trữ,
+#   nội dung là các dòng "<id>\t<JSON tin nhắn>\n" theo thứ tự id tăng dần.
+# - "index": mỗi block một bản ghi cố định (id đầu, id cuối, segment, offset, độ dài, số tin).
+#   ID của stream bắt đầu bằng timestamp (ms) nên index cũng là chỉ mục theo thời gian.
+# Block được ghi (và fsync) trước bản ghi index, nên người đọc không bao giờ thấy block dở dang.
+_RECORD = struct.Struct("<QIQIIQII")
+
+# Chỉ một worker trong cụm chạy archiver tại một thời điểm. Khóa được gia hạn trước mỗi lần ghi block
+# và trước XTRIM; nếu đã mất khóa (lượt chạy quá lâu) thì dừng ngay để không ghi trùng với worker khác.
+_LOCK_KEY = "archive_lock"
+_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if ARGV[3] == '1' and redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+
+def _id_tuple(message_id: str) -> Tuple[int, int]:
+    ms, _, seq = message_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+class SegmentStore:
+    """Đọc/ghi các segment lưu trữ của từng phòng; mọi hàm ở đây là I/O đồng bộ, gọi qua thread."""
+
+    def __init__(self, root: str = ARCHIVE_DIR, segment_bytes: int = ARCHIVE_SEGMENT_BYTES):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.indexes: Dict[str, Tuple[int, list]] = {}  # roomId -> (kích thước file index, các bản ghi)
+
+    def room_dir(self, room_id: str) -> str:
+        # roomId do client đặt, mã hóa hex để không thể thoát ra ngoài ARCHIVE_DIR
+        return os.path.join(self.root, str(room_id).encode().hex())
+
+    def records(self, room_id: str) -> list:
+        path = os.path.join(self.room_dir(room_id), "index")
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return []
+        size -= size % _RECORD.size
+        cached = self.indexes.get(room_id)
+        if cached is not None and cached[0] == size:
+            return cached[1]
+        records = []
+        if size:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                records = list(_RECORD.iter_unpack(m[:size]))
+        self.indexes[room_id] = (size, records)
+        return records
+
+    def last_id(self, room_id: str) -> Optional[str]:
+        records = self.records(room_id)
+        if not records:
+            return None
+        return f"{records[-1][2]}-{records[-1][3]}"
+
+    def append(self, room_id: str, entries: List[Tuple[str, str]]):
+        # entries = [(id, JSON), ...] theo thứ tự id tăng dần, tất cả mới hơn last_id()
+        directory = self.room_dir(room_id)
+        os.makedirs(directory, exist_ok=True)
+        records = self.records(room_id)
+        segment = records[-1][4] if records else 0
+        path = os.path.join(directory, f"{segment:06d}.seg")
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset >= self.segment_bytes:
+            segment, offset = segment + 1, 0
+            path = os.path.join(directory, f"{segment:06d}.seg")
+        block = zlib.compress("".join(f"{entry_id}\t{text}\n" for entry_id, text in entries).encode())
+        with open(path, "ab") as f:
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        first, last = _id_tuple(entries[0][0]), _id_tuple(entries[-1][0])
+        with open(os.path.join(directory, "index"), "ab") as f:
+            f.write(_RECORD.pack(*first, *last, segment, offset, len(block), len(entries)))
+            f.flush()
+            os.fsync(f.fileno())
+        metrics.archive_bytes.inc(len(block))
+
+    def read_before(self, room_id: str, limit: int, before: Optional[str] = None) -> List[dict]:
+        """Trả về tối đa `limit` tin nhắn đã lưu trữ (cũ -> mới) có id nhỏ hơn `before`."""
+        bound = _id_tuple(before) if before else None
+        directory = self.room_dir(room_id)
+        blocks: List[List[dict]] = []
+        found = 0
+        maps = {}
+        try:
+            for first_ms, first_seq, _, _, segment, offset, length, _ in reversed(self.records(room_id)):
+                if bound is not None and (first_ms, first_seq) >= bound:
+                    continue
+                if segment not in maps:
+                    f = open(os.path.join(directory, f"{segment:06d}.seg"), "rb")
+                    maps[segment] = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                data = zlib.decompress(maps[segment][1][offset:offset + length]).decode()
+                messages = []
+                for line in data.splitlines():
+                    entry_id, _, text = line.partition("\t")
+                    if bound is not None and _id_tuple(entry_id) >= bound:
+                        break
+                    message = loads(text)
+                    message["id"] = entry_id
+                    messages.append(message)
+                blocks.append(messages)
+                found += len(messages)
+                if found >= limit:
+                    break
+        finally:
+            for f, m in maps.values():
+                m.close()
+                f.close()
+        messages = [message for block in reversed(blocks) for message in block]
+        return messages[-limit:] if limit > 0 else []
+
+    async def read(self, room_id: str, limit: int, before: Optional[str] = None) -> List[dict]:
+        with metrics.archive_read_seconds.time():
+            return await asyncio.to_thread(self.read_before, room_id, limit, before)
+
+
+class LockLost(Exception):
+    pass
+
+
+class Archiver:
+    """Chuyển lịch sử cũ của các phòng từ Redis Stream sang segment trên đĩa.
+
+    Entry được lưu khi cũ hơn `after` giây hoặc nằm ngoài `hot_len` entry mới nhất của phòng.
+    Mỗi lượt đọc tiếp từ id cuối đã lưu, ghi một block rồi mới XTRIM MINID khỏi stream,
+    nên nếu worker chết giữa chừng thì lượt sau không lưu trùng và không mất tin.
+    """
+
+    def __init__(self, store: SegmentStore, enabled: bool = ARCHIVE_ENABLED, interval: float = ARCHIVE_INTERVAL,
+                 after: float = ARCHIVE_AFTER, hot_len: int = HISTORY_MAX_LEN, batch_size: int = ARCHIVE_BATCH):
+        self.store = store
+        self.enabled = enabled
+        self.interval = interval
+        self.after = after
+        self.hot_len = hot_len
+        self.batch_size = batch_size
+        self.task: Optional[asyncio.Task] = None
+        self.lock_script = None
+
+    def start(self):
+        if self.enabled:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.archive_all()
+            except LockLost:
+                logger.warning("Archive lock lost, stopping this pass")
+            except Exception as e:
+                logger.error(f"Archive failed: {e}")
+
+    async def _hold_lock(self, acquire: bool = False) -> bool:
+        # acquire=False: chỉ gia hạn khi vẫn đang giữ khóa, không lấy lại khóa đã mất giữa một lượt
+        if self.lock_script is None:
+            self.lock_script = get_redis().register_script(_LOCK_SCRIPT)
+        ttl = int(self.interval * 3000)
+        return bool(await self.lock_script(keys=[_LOCK_KEY], args=[WORKER_ID, ttl, int(acquire)]))
+
+    async def _check_lock(self):
+        if not await self._hold_lock():
+            raise LockLost()
+
+    async def archive_all(self) -> int:
+        if not await self._hold_lock(acquire=True):
+            return 0
+        total = 0
+        prefix = f"{REDIS_STREAM_PREFIX}:"
+        async for key in get_redis().scan_iter(match=f"{prefix}*", count=500, _type="STREAM"):
+            total += await self.archive_room(key[len(prefix):])
+        return total
+
+    async def archive_room(self, room_id: str) -> int:
+        redis = get_redis()
+        key = f"{REDIS_STREAM_PREFIX}:{room_id}"
+        cutoff = int((time.time() - self.after) * 1000)
+        excess = max(0, await redis.xlen(key) - self.hot_len)
+        last = await asyncio.to_thread(self.store.last_id, room_id)
+        total = 0
+        while True:
+            entries = await redis.xrange(key, min=f"({last}" if last else "-", max="+", count=self.batch_size)
+            chosen = []
+            for entry_id, fields in entries:
+                if excess <= 0 and _id_tuple(entry_id)[0] >= cutoff:
+                    break
+                chosen.append((entry_id, fields["d"]))
+                excess -= 1
+            if not chosen:
+                break
+            await self._check_lock()
+            await asyncio.to_thread(self.store.append, room_id, chosen)
+            last = chosen[-1][0]
+            total += len(chosen)
+            metrics.archived_messages.inc(len(chosen))
+            if len(chosen) < self.batch_size:
+                break
+        if last:
+            # Cắt cả những entry đã lưu ở lượt trước nhưng chưa kịp cắt
+            ms, seq = _id_tuple(last)
+            await self._check_lock()
+            with metrics.redis_seconds.time(op="archive_trim"):
+                await redis.xtrim(key, minid=f"{ms}-{seq + 1}", approximate=False)
+        return total
+
+
+segments = SegmentStore()
+archiver = Archiver(segments)
@@ -0,0 +1,346 @@
+# ./benchmarks/bench.py
+"""Benchmark cho đường broadcast/websocket và REST.
+
+Chạy trong process với fakeredis (mặc định) hoặc với Redis thật (--redis), kết quả ghi ra JSON
+để so sánh giữa các lần chạy:
+
+    python benchmarks/bench.py --out before.json
+    python benchmarks/bench.py --out after.json --compare before.json
+
+Chế độ --ws-url đo end-to-end qua WebSocket thật với một server đang chạy.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeWebSocket:
+    """WebSocket giả, ghi lại thời điểm nhận mỗi frame để đo độ trễ fan-out."""
+
+    def __init__(self, session_id: str, room_id: str, tracker: "DeliveryTracker", delay: float = 0.0):
+        self.query_params = {"sessionId": session_id, "roomId": room_id}
+        self.headers = {}
+        self.tracker = tracker
+        self.delay = delay
+        self.received = 0
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        pass
+
+    async def send_text(self, text: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+        self.tracker.delivered(text, self.delay > 0)
+
+
+class DeliveryTracker:
+    def __init__(self):
+        self.pending = {}  # id(frame text) -> [thời điểm gửi, số người nhận nhanh còn thiếu]
+        self.latencies = []
+
+    def expect(self, text: str, recipients: int):
+        self.pending[id(text)] = [time.perf_counter(), recipients]
+
+    def delivered(self, text: str, slow: bool):
+        item = self.pending.get(id(text))
+        if item is None or slow:
+            return
+        item[1] -= 1
+        if item[1] == 0:
+            self.latencies.append(time.perf_counter() - item[0])
+            del self.pending[id(text)]
+
+
+def percentiles(samples):
+    if not samples:
+        return {"p50_ms": None, "p99_ms": None, "max_ms": None, "count": 0}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"p50_ms": round(pick(0.50), 3), "p99_ms": round(pick(0.99), 3), "max_ms": round(ordered[-1] * 1000, 3), "count": len(ordered)}
+
+
+async def setup_redis(args):
+    import redis_client
+    if args.redis:
+        redis_client.REDIS_HOST, redis_client.REDIS_PORT = args.redis.split(":")[0], int(args.redis.split(":")[1])
+        await redis_client.init_redis()
+    else:
+        import fakeredis
+        redis_client.redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    from pubsub import broker
+    from persistence import persistence
+    from manager import manager
+    await broker.start(manager.deliver_local)
+    persistence.start()
+
+
+async def connect_clients(rooms, per_room, tracker, slow_ratio=0.0, slow_delay=0.0, prefix="u"):
+    from manager import manager
+    from sessions import sessions
+    connections = []
+    for r in range(rooms):
+        room_id = f"bench-{prefix}-{r}"
+        manager.room_options.set(room_id, {"type": "public", "max_connections_per_ip": None})
+        for i in range(per_room):
+            username = f"{prefix}{r}-{i}"
+            session_id = sessions.issue(username)
+            slow = random.random() < slow_ratio
+            ws = FakeWebSocket(session_id, room_id, tracker, slow_delay if slow else 0.0)
+            connection = await manager.connect(ws, username, username, room_id)
+            connections.append((connection, slow))
+    return connections
+
+
+async def drain(seconds: float = 0.5):
+    await asyncio.sleep(seconds)
+
+
+async def bench_fanout(args, slow_ratio=0.0):
+    from manager import manager
+    from serialization import Frame
+    tracker = DeliveryTracker()
+    connections = await connect_clients(args.rooms, args.clients, tracker, slow_ratio, args.slow_delay,
+                                        prefix="slow" if slow_ratio else "fan")
+    await drain(1.0)
+    tracker.latencies.clear()
+    fast_by_room = {}
+    for connection, slow in connections:
+        if not slow:
+            fast_by_room[connection.room_id] = fast_by_room.get(connection.room_id, 0) + 1
+    rooms = list(fast_by_room)
+    start = time.perf_counter()
+    for n in range(args.messages):
+        room_id = rooms[n % len(rooms)]
+        frame = Frame({"type": "message", "username": "bench", "content": {"text": f"m{n}"}, "roomId": room_id})
+        tracker.expect(frame.text, fast_by_room[room_id])
+        await manager.broadcast(frame, room_id)
+        if n % 100 == 0:
+            await asyncio.sleep(0)
+    while tracker.pending and time.perf_counter() - start < 30:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    delivered = len(tracker.latencies) * (sum(fast_by_room.values()) / len(rooms))
+    for connection, _ in connections:
+        await manager.disconnect(connection)
+    import metrics
+    return {
+        "connections": len(connections),
+        "fanout_latency": percentiles(tracker.latencies),
+        "messages_per_sec": round(args.messages / elapsed, 1),
+        "deliveries_per_sec": round(delivered / elapsed, 1),
+        "dropped_total": metrics.send_dropped.get(),
+    }
+
+
+async def bench_join_storm(args):
+    tracker = DeliveryTracker()
+    from manager import manager
+    room_id = "bench-storm"
+    manager.room_options.set(room_id, {"type": "public", "max_connections_per_ip": None})
+    from sessions import sessions
+    watcher = FakeWebSocket(sessions.issue("watcher"), room_id, tracker)
+    watcher_connection = await manager.connect(watcher, "watcher", "watcher", room_id)
+    await drain(1.0)
+    before = watcher.received
+
+    async def join(i):
+        username = f"storm-{i}"
+        websocket = FakeWebSocket(sessions.issue(username), room_id, tracker)
+        started = time.perf_counter()
+        connection = await manager.connect(websocket, username, username, room_id)
+        return connection, time.perf_counter() - started
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[join(i) for i in range(args.storm)])
+    elapsed = time.perf_counter() - start
+    await drain(1.0)
+    frames_to_watcher = watcher.received - before
+    for connection, _ in results:
+        await manager.disconnect(connection)
+    await manager.disconnect(watcher_connection)
+    return {
+        "joins": args.storm,
+        "connect_latency": percentiles([latency for _, latency in results]),
+        "joins_per_sec": round(args.storm / elapsed, 1),
+        "frames_to_existing_member": frames_to_watcher,
+    }
+
+
+async def bench_history(args):
+    import httpx
+    from main import app
+    from persistence import persistence
+    from history import next_message_id
+    from serialization import dumps
+    room_id = f"bench-history-{int(time.time())}"  # phòng mới mỗi lần chạy, không đụng dữ liệu cũ
+    for n in range(args.history):
+        message_id = next_message_id()
+        await persistence.append(room_id, message_id, dumps({"id": message_id, "type": "message", "username": "bench", "content": {"text": "x" * 64}}))
+    await persistence.append(room_id, next_message_id(), "{}", durable=True)
+
+    latencies, sizes = [], []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        before = None
+        for _ in range(args.pages):
+            params = {"limit": 50}
+            if before:
+                params["before"] = before
+            started = time.perf_counter()
+            response = await client.get(f"/messages/{room_id}/", params=params)
+            latencies.append(time.perf_counter() - started)
+            sizes.append(len(response.content))
+            page = response.json()
+            before = page[0]["id"] if page else None
+    return {
+        "stored_messages": args.history,
+        "page_latency": percentiles(latencies),
+        "avg_page_bytes": round(statistics.mean(sizes)) if sizes else 0,
+    }
+
+
+async def bench_memory(args):
+    tracker = DeliveryTracker()
+    from manager import manager
+    await drain(0.1)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    connections = await connect_clients(1, args.memory_clients, tracker, prefix="mem")
+    await drain(1.0)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    for connection, _ in connections:
+        await manager.disconnect(connection)
+    return {"connections": len(connections), "bytes_per_connection": round(allocated / len(connections))}
+
+
+async def bench_ws(args):
+    # End-to-end qua WebSocket thật: đo từ lúc gửi đến lúc người nhận cuối cùng nhận được tin
+    import urllib.request
+    import websockets
+
+    async def open_client(i):
+        username = f"ws{i}"
+        with urllib.request.urlopen(f"{args.http_url}/session/{username}") as response:
+            token = json.loads(response.read())["sessionId"]
+        return await websockets.connect(f"{args.ws_url}/ws/chat/{username}?sessionId={token}&roomId=bench-ws", max_queue=None)
+
+    clients = await asyncio.gather(*[open_client(i) for i in range(args.clients)])
+    received = {}
+
+    async def reader(ws):
+        async for raw in ws:
+            data = json.loads(raw)
+            if data.get("type") == "message" and data["content"].get("bench"):
+                received.setdefault(data["content"]["bench"], []).append(time.perf_counter())
+
+    readers = [asyncio.create_task(reader(ws)) for ws in clients]
+    await asyncio.sleep(1.0)
+    sent = {}
+    for n in range(args.messages):
+        key = f"m{n}"
+        sent[key] = time.perf_counter()
+        await clients[n % len(clients)].send(json.dumps({"type": "message", "content": {"text": key, "bench": key}, "roomId": "bench-ws"}))
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(2.0)
+    latencies = [max(times) - sent[key] for key, times in received.items() if len(times) >= len(clients)]
+    for task in readers:
+        task.cancel()
+    for ws in clients:
+        await ws.close()
+    return {"clients": args.clients, "complete_messages": len(latencies), "fanout_latency": percentiles(latencies)}
+
+
+def compare(current: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    def walk(prefix, new, old):
+        for key, value in new.items():
+            path = f"{prefix}.{key}" if prefix else key
+            if isinstance(value, dict):
+                walk(path, value, old.get(key, {}) if isinstance(old, dict) else {})
+            elif isinstance(value, (int, float)) and isinstance(old, dict) and isinstance(old.get(key), (int, float)) and old[key]:
+                change = (value - old[key]) / old[key] * 100
+                print(f"{path:50s} {old[key]:>12} -> {value:>12} ({change:+.1f}%)")
+
+    walk("", current["results"], baseline.get("results", {}))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis", help="host:port của Redis thật (mặc định dùng fakeredis)")
+    parser.add_argument("--scenarios", default="fanout,slow,storm,history,memory")
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--clients", type=int, default=100, help="số client mỗi phòng")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--slow-ratio", type=float, default=0.05)
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="thời gian (giây) client chậm mất cho mỗi frame")
+    parser.add_argument("--storm", type=int, default=1000, help="số client cùng vào một phòng")
+    parser.add_argument("--history", type=int, default=5000, help="số tin nhắn trong phòng lịch sử lớn")
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--memory-clients", type=int, default=2000)
+    parser.add_argument("--ws-url", help="ví dụ ws://127.0.0.1:8000; chỉ chạy kịch bản end-to-end")
+    parser.add_argument("--http-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="ghi kết quả JSON ra file")
+    parser.add_argument("--compare", help="file JSON của lần chạy trước để so sánh")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    results = {}
+    if args.ws_url:
+        results["ws"] = await bench_ws(args)
+    else:
+        await setup_redis(args)
+        scenarios = args.scenarios.split(",")
+        if "fanout" in scenarios:
+            results["fanout"] = await bench_fanout(args)
+        if "slow" in scenarios:
+            results["slow_consumers"] = await bench_fanout(args, slow_ratio=args.slow_ratio)
+        if "storm" in scenarios:
+            results["join_storm"] = await bench_join_storm(args)
+        if "history" in scenarios:
+            results["history"] = await bench_history(args)
+        if "memory" in scenarios:
+            results["memory"] = await bench_memory(args)
+        from persistence import persistence
+        from pubsub import broker
+        await persistence.stop()
+        await broker.stop()
+        from redis_client import get_redis
+        await get_redis().aclose()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "redis": args.redis or "fakeredis",
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "results": results,
+    }
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
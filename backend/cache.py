@@ -0,0 +1,56 @@
+# ./cache.py
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """LRU có giới hạn kích thước, mỗi phần tử hết hạn sau `ttl` giây (ttl=None: không hết hạn)."""
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: "OrderedDict[Hashable, tuple]" = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self.data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = _MISSING):
+        ttl = self.ttl if ttl is TTLCache._MISSING else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, TTLCache._MISSING) is not TTLCache._MISSING
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self.get(key, TTLCache._MISSING)
+        if value is TTLCache._MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: Hashable, value: Any):
+        self.set(key, value)
+
+    def __len__(self) -> int:
+        return len(self.data)
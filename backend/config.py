@@ -1,5 +1,111 @@
 import os
+import uuid
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_CHANNEL = "chat"
+# Lịch sử tin nhắn mỗi phòng lưu trong Redis Stream "chat_stream:{roomId}"
+REDIS_STREAM_PREFIX = os.getenv("REDIS_STREAM_PREFIX", "chat_stream")
+
+# Pub/sub giữa các worker: mỗi phòng là một channel "chat_events:{roomId}"
+REDIS_PUBSUB_PREFIX = os.getenv("REDIS_PUBSUB_PREFIX", "chat_events")
+# Mỗi process uvicorn có một id riêng để bỏ qua tin nhắn do chính nó publish
+WORKER_ID = uuid.uuid4().hex
+
+# Hàng đợi gửi của mỗi kết nối: số tin nhắn tối đa chờ gửi trước khi coi là client chậm
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+# "drop": ngắt kết nối client chậm (client kết nối lại và nhận bù theo lastSeenId); "coalesce": bỏ bớt
+# thông báo và danh sách online cũ, chỉ ngắt khi phải bỏ một tin chat
+SLOW_CONSUMER_POLICY = os.getenv("SLOW_CONSUMER_POLICY", "drop")
+
+# Lịch sử tin nhắn: số tin giữ lại trong Redis mỗi phòng, số tin gửi khi join và kích thước trang REST
+HISTORY_MAX_LEN = int(os.getenv("HISTORY_MAX_LEN", "1000"))
+HISTORY_JOIN_SIZE = int(os.getenv("HISTORY_JOIN_SIZE", "50"))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "200"))
+
+# Ghi tin nhắn vào Redis theo lô (write-behind): tối đa PERSIST_BATCH_SIZE tin hoặc sau PERSIST_FLUSH_INTERVAL giây
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "256"))
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.005"))
+# Số tin chờ ghi tối đa; khi đầy, vòng nhận tin sẽ phải chờ (backpressure)
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", "10000"))
+PERSIST_RETRIES = int(os.getenv("PERSIST_RETRIES", "3"))
+# "1": chỉ broadcast sau khi Redis đã ghi xong (chậm hơn nhưng không mất tin khi worker chết)
+PERSIST_DURABLE = os.getenv("PERSIST_DURABLE", "0") == "1"
+
+# Cache trong process cho cấu hình phòng và danh sách phòng; các worker khác được báo xóa cache qua pub/sub
+ROOM_OPTIONS_CACHE_SIZE = int(os.getenv("ROOM_OPTIONS_CACHE_SIZE", "10000"))
+ROOM_OPTIONS_CACHE_TTL = float(os.getenv("ROOM_OPTIONS_CACHE_TTL", "300"))
+ROOMS_CACHE_TTL = float(os.getenv("ROOMS_CACHE_TTL", "30"))
+
+# Thời gian (giây) một suất kết nối theo IP được giữ nếu worker không trả lại (ví dụ worker bị kill);
+# suất của kết nối còn sống được gia hạn ở mỗi nhịp heartbeat
+IP_SLOT_TTL = int(os.getenv("IP_SLOT_TTL", "120"))
+
+# Entry "user đang online" của mỗi worker hết hạn sau PRESENCE_TTL giây nếu không được heartbeat gia hạn,
+# nên user trên worker bị kill/crash sẽ được báo rời phòng thay vì online mãi
+PRESENCE_TTL = int(os.getenv("PRESENCE_TTL", "120"))
+# Gom các sự kiện vào/rời phòng trong cửa sổ này (giây) thành một tin "presence" và một thông báo
+PRESENCE_WINDOW = float(os.getenv("PRESENCE_WINDOW", "0.25"))
+# Số tên tối đa hiển thị trong thông báo gộp, phần còn lại ghi là "và N người khác"
+PRESENCE_NOTIFY_NAMES = int(os.getenv("PRESENCE_NOTIFY_NAMES", "3"))
+
+# Profiler lấy mẫu cho broadcast và vòng nhận tin: 0 là tắt, 0.001 là đo khoảng 1/1000 lượt chạy
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+# Cache token phiên (JWT) đã xác thực, tránh verify chữ ký lại mỗi lần kết nối lại
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "50000"))
+SESSION_VERIFY_TTL = float(os.getenv("SESSION_VERIFY_TTL", "3600"))
+# /session trả lại token đã cấp cho cùng username trong khoảng này (giây) thay vì ký token mới
+SESSION_REUSE_WINDOW = float(os.getenv("SESSION_REUSE_WINDOW", "3600"))
+
+# Server gửi ping mỗi HEARTBEAT_INTERVAL giây (phải nhỏ hơn proxy_read_timeout 60s của nginx);
+# kết nối không gửi gì (kể cả pong) trong IDLE_TIMEOUT giây bị coi là đã chết
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "25"))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "75"))
+# Reaper quét kết nối chết mỗi REAPER_INTERVAL giây, mỗi lượt đóng tối đa REAPER_BATCH kết nối
+REAPER_INTERVAL = float(os.getenv("REAPER_INTERVAL", "5"))
+REAPER_BATCH = int(os.getenv("REAPER_BATCH", "500"))
+
+# Giới hạn tốc độ gửi tin (token bucket dùng chung cho cả cluster qua Redis): RATE = số tin/giây
+# được nạp lại, BURST = số tin tối đa gửi dồn một lúc; RATE <= 0 là tắt giới hạn đó
+RATE_USER = float(os.getenv("RATE_USER", "5"))
+RATE_USER_BURST = int(os.getenv("RATE_USER_BURST", "20"))
+RATE_IP = float(os.getenv("RATE_IP", "20"))
+RATE_IP_BURST = int(os.getenv("RATE_IP_BURST", "60"))
+RATE_ROOM = float(os.getenv("RATE_ROOM", "200"))
+RATE_ROOM_BURST = int(os.getenv("RATE_ROOM_BURST", "400"))
+# Bucket riêng cho frame điều khiển (publicKey, getKeys, users) của mỗi user
+RATE_CONTROL = float(os.getenv("RATE_CONTROL", "2"))
+RATE_CONTROL_BURST = int(os.getenv("RATE_CONTROL_BURST", "10"))
+# Worker mượn trước tối đa RATE_LEASE_MAX token từ Redis cho client gửi liên tục, dùng trong RATE_LEASE_TTL giây
+RATE_LEASE_MAX = int(os.getenv("RATE_LEASE_MAX", "8"))
+RATE_LEASE_TTL = float(os.getenv("RATE_LEASE_TTL", "1"))
+# "drop": bỏ tin vượt giới hạn và báo lỗi cho client; "delay": chờ tối đa RATE_MAX_DELAY giây rồi thử lại
+RATE_LIMIT_POLICY = os.getenv("RATE_LIMIT_POLICY", "drop")
+RATE_MAX_DELAY = float(os.getenv("RATE_MAX_DELAY", "1"))
+
+# Chia phòng theo node (consistent hashing): mỗi phòng chỉ do một node phục vụ, client kết nối nhầm
+# node sẽ được chuyển hướng. NODE_URL là địa chỉ WebSocket công khai của node này (ví dụ ws://10.0.0.5:8000)
+SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "0") == "1"
+NODE_URL = os.getenv("NODE_URL", "ws://localhost:8000")
+# Node gia hạn tư cách thành viên mỗi NODE_HEARTBEAT giây, quá NODE_TTL giây không gia hạn thì bị loại
+NODE_HEARTBEAT = float(os.getenv("NODE_HEARTBEAT", "5"))
+NODE_TTL = float(os.getenv("NODE_TTL", "15"))
+# Số điểm ảo của mỗi node trên vòng hash, càng nhiều thì phòng chia càng đều
+HASH_VNODES = int(os.getenv("HASH_VNODES", "64"))
+# Số kết nối tối đa chuyển sang node khác trong một lượt khi vòng hash thay đổi
+HANDOFF_BATCH = int(os.getenv("HANDOFF_BATCH", "500"))
+
+# Số user đã rời phòng được giữ dấu xóa trong danh bạ publicKey; client có version cũ hơn sẽ nhận lại toàn bộ
+PUBLIC_KEY_TOMBSTONES = int(os.getenv("PUBLIC_KEY_TOMBSTONES", "1000"))
+
+# Lưu trữ lịch sử cũ ra file nén trên đĩa: tin cũ hơn ARCHIVE_AFTER giây, hoặc nằm ngoài HISTORY_MAX_LEN
+# tin mới nhất của phòng, được chuyển khỏi Redis sang ARCHIVE_DIR (khi nhiều node, dùng thư mục chung).
+# Khi bật, stream không còn bị cắt bằng MAXLEN lúc ghi mà do archiver cắt sau khi đã lưu xong.
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "0") == "1"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_AFTER = float(os.getenv("ARCHIVE_AFTER", "86400"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "60"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "1000"))
+ARCHIVE_SEGMENT_BYTES = int(os.getenv("ARCHIVE_SEGMENT_BYTES", str(16 * 1024 * 1024)))
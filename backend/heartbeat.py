@@ -0,0 +1,92 @@
+# ./heartbeat.py
+import asyncio
+import logging
+import time
+from typing import Optional
+from config import HEARTBEAT_INTERVAL, IDLE_TIMEOUT, REAPER_INTERVAL, REAPER_BATCH
+from redis_client import refresh_ip_slots
+from serialization import Frame
+from manager import manager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Một frame ping dùng chung cho mọi kết nối, chỉ encode một lần
+PING = Frame({"type": "ping"})
+
+
+class Heartbeat:
+    """Ping định kỳ mọi kết nối của worker và dọn các kết nối không còn phản hồi.
+
+    Ping giữ cho nginx không cắt kết nối rảnh và buộc client trả lời pong; mỗi frame
+    nhận được cập nhật Connection.last_seen. Reaper đóng các kết nối im lặng quá
+    IDLE_TIMEOUT, tối đa REAPER_BATCH kết nối mỗi lượt, qua manager.disconnect nên
+    registry, presence và suất IP trong Redis đều được dọn.
+    """
+
+    def __init__(self, manager, interval: float = HEARTBEAT_INTERVAL, idle_timeout: float = IDLE_TIMEOUT,
+                 reap_interval: float = REAPER_INTERVAL, batch_size: int = REAPER_BATCH):
+        self.manager = manager
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.reap_interval = reap_interval
+        self.batch_size = batch_size
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._ping_loop()), asyncio.create_task(self._reap_loop())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for task in self.tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.tasks = []
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.ping()
+            except Exception as e:
+                logger.error(f"Heartbeat failed: {e}")
+
+    async def ping(self):
+        slots = []
+        for connection in list(self.manager.registry.all()):
+            connection.sender.send(PING)
+            if connection.ip_slot:
+                slots.append((connection.room_id, connection.client_ip, connection.ip_slot))
+        # Gia hạn suất IP và entry online của các kết nối còn mở, theo từng lô để mỗi lệnh Redis không quá lớn
+        for i in range(0, len(slots), self.batch_size):
+            await refresh_ip_slots(slots[i:i + self.batch_size])
+        await self.manager.refresh_presence(self.batch_size)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(f"Reaper failed: {e}")
+
+    async def reap(self, now: Optional[float] = None) -> int:
+        deadline = (now or time.monotonic()) - self.idle_timeout
+        stale = []
+        for connection in self.manager.registry.all():
+            if connection.last_seen < deadline:
+                stale.append(connection)
+                if len(stale) >= self.batch_size:
+                    break
+        for connection in stale:
+            connection.sender.abort(reason="Idle timeout.")
+            await self.manager.disconnect(connection)
+        if stale:
+            metrics.reaped_connections.inc(len(stale))
+        return len(stale)
+
+
+heartbeat = Heartbeat(manager)
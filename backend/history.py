@@ -0,0 +1,128 @@
+# ./history.py
+import time
+from typing import List, Optional, Tuple
+from redis_client import get_redis
+from config import REDIS_STREAM_PREFIX, HISTORY_MAX_LEN, ARCHIVE_ENABLED
+from serialization import loads
+from archive import segments
+import metrics
+
+# Lịch sử mỗi phòng là một Redis Stream "chat_stream:{roomId}", mỗi entry có một field "d"
+# chứa JSON của tin nhắn. ID của entry ("<ms>-<seq>") tăng dần và được dùng làm cursor
+# cho phân trang lẫn cho việc gửi bù tin nhắn khi client kết nối lại.
+
+# ID được cấp ngay trên worker để frame gửi cho client đã chứa sẵn id và chỉ cần encode
+# một lần. Nếu ID không lớn hơn entry cuối (lệch đồng hồ giữa các worker) thì để Redis tự
+# cấp ID; khi đọc lại, id luôn lấy theo ID thật của entry. Khi đó id đã gửi cho client không còn
+# đúng: chế độ durable broadcast bằng id thật, chế độ ghi nền gửi thêm frame "ids" để client sửa lại.
+# ARGV[1] = 0 nghĩa là không cắt stream khi ghi (archiver sẽ cắt sau khi đã lưu ra đĩa).
+# ARGV[2] = 1 khi ghi lại một lô đã gửi: lượt trước có thể đã chạy xong trong Redis (chỉ lỗi lúc đọc kết quả),
+# nên tin nào đã có trong stream thì trả lại id đã ghi thay vì thêm bản trùng. JSON của mỗi tin chứa id tạm
+# nên là duy nhất; entry do Redis tự cấp id luôn nằm sau id tạm, trong 1000 entry mới nhất.
+_APPEND_SCRIPT = """
+local function xadd(call, id, data)
+    if ARGV[1] == '0' then
+        return call('XADD', KEYS[1], id, 'd', data)
+    end
+    return call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], id, 'd', data)
+end
+local function stored(id, data)
+    local found = redis.call('XRANGE', KEYS[1], id, id)
+    if found[1] and found[1][2][2] == data then
+        return found[1][1]
+    end
+    for _, entry in ipairs(redis.call('XREVRANGE', KEYS[1], '+', '(' .. id, 'COUNT', 1000)) do
+        if entry[2][2] == data then
+            return entry[1]
+        end
+    end
+    return nil
+end
+local ids = {}
+for i = 3, #ARGV, 2 do
+    local id = xadd(redis.pcall, ARGV[i], ARGV[i + 1])
+    if type(id) == 'table' and id.err then
+        id = ARGV[2] == '1' and stored(ARGV[i], ARGV[i + 1]) or xadd(redis.call, '*', ARGV[i + 1])
+    end
+    ids[#ids + 1] = id
+end
+return ids
+"""
+
+_append_script = None
+_last_ms = 0
+_last_seq = 0
+
+
+def stream_key(room_id: str) -> str:
+    return f"{REDIS_STREAM_PREFIX}:{room_id}"
+
+
+def next_message_id() -> str:
+    global _last_ms, _last_seq
+    now = int(time.time() * 1000)
+    if now <= _last_ms:
+        _last_seq += 1
+    else:
+        _last_ms, _last_seq = now, 0
+    return f"{_last_ms}-{_last_seq}"
+
+
+def _script():
+    global _append_script
+    if _append_script is None:
+        _append_script = get_redis().register_script(_APPEND_SCRIPT)
+    return _append_script
+
+
+def append_messages(room_id: str, entries: List[Tuple[str, str]], client=None, retry: bool = False):
+    # entries = [(message_id, text), ...]; truyền client là pipeline để gom nhiều phòng vào một lượt gửi.
+    # retry=True khi ghi lại lô có thể đã được ghi, để không tạo bản trùng
+    args = [0 if ARCHIVE_ENABLED else HISTORY_MAX_LEN, int(retry)]
+    for message_id, text in entries:
+        args += [message_id, text]
+    return _script()(keys=[stream_key(room_id)], args=args, client=client)
+
+
+def _decode(entries: list) -> List[dict]:
+    messages = []
+    for entry_id, fields in entries:
+        message = loads(fields["d"])
+        message["id"] = entry_id
+        messages.append(message)
+    return messages
+
+
+async def read_history(room_id: str, limit: int, before: Optional[str] = None) -> List[dict]:
+    """Trả về tối đa `limit` tin nhắn (cũ -> mới) có id nhỏ hơn `before`, mặc định là các tin mới nhất."""
+    redis = get_redis()
+    with metrics.redis_seconds.time(op="history_read"):
+        entries = await redis.xrevrange(stream_key(room_id), max=f"({before}" if before else "+", min="-", count=limit)
+    entries.reverse()
+    messages = _decode(entries)
+    if ARCHIVE_ENABLED and len(messages) < limit:
+        # Đã cuộn qua phần lịch sử còn trong Redis: đọc tiếp từ các segment đã lưu trữ trên đĩa
+        older = await segments.read(room_id, limit - len(messages), messages[0]["id"] if messages else before)
+        messages = older + messages
+    return messages
+
+
+async def read_since(room_id: str, last_seen_id: str, limit: int) -> Tuple[List[dict], bool]:
+    """Trả về tối đa `limit` tin nhắn có id lớn hơn `last_seen_id` và cờ cho biết còn tin mới hơn hay không."""
+    redis = get_redis()
+    with metrics.redis_seconds.time(op="history_since"):
+        entries = await redis.xrange(stream_key(room_id), min=f"({last_seen_id}", max="+", count=limit + 1)
+    return _decode(entries[:limit]), len(entries) > limit
+
+
+async def has_gap(room_id: str, last_seen_id: str) -> bool:
+    # Client đã bỏ lỡ cả những tin đã bị cắt khỏi stream, không thể gửi bù chính xác
+    redis = get_redis()
+    with metrics.redis_seconds.time(op="history_first"):
+        first = await redis.xrange(stream_key(room_id), min="-", max="+", count=1)
+    return bool(first) and _id_tuple(first[0][0]) > _id_tuple(last_seen_id)
+
+
+def _id_tuple(message_id: str) -> Tuple[int, int]:
+    ms, _, seq = message_id.partition("-")
+    return int(ms), int(seq or 0)
@@ -3,8 +3,15 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from redis_client import init_redis
+from pubsub import broker
+from persistence import persistence
+from manager import manager
+from heartbeat import heartbeat
+from sharding import shards
+from archive import archiver
 from routers.websocket import websocket_router
 from routers.chat_api import api_router
+from routers.metrics import metrics_router
 import logging
 
 app = FastAPI()
@@ -27,10 +34,24 @@ logging.getLogger("fastapi").setLevel(logging.ERROR)
 @app.on_event("startup")
 async def startup():
     await init_redis()
+    await broker.start(manager.deliver_local)
+    persistence.start(manager.remap_ids)
+    heartbeat.start()
+    archiver.start()
+    await shards.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await shards.stop()
+    await archiver.stop()
+    await heartbeat.stop()
+    await persistence.stop()
+    await broker.stop()
 
 # Include routers
 app.include_router(api_router)
 app.include_router(websocket_router)
+app.include_router(metrics_router)
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,37 +1,32 @@
 # ./manager.py
 from fastapi import WebSocket
-from typing import Dict
+from typing import Optional
 import logging
 import uuid
 import json
-from redis_client import add_user_to_ip, remove_user_from_ip, get_users_for_ip, set_session, get_redis
+from redis_client import (acquire_ip_slot, release_ip_slot, get_redis, add_room_user, remove_room_user,
+                          refresh_room_users, get_room_users)
+from pubsub import broker
+from sender import ConnectionSender
+from registry import Connection, ConnectionRegistry
+from presence import PresenceBatcher
+from sessions import sessions
+from public_keys import remove_key
+from serialization import Frame
+from cache import TTLCache
+from config import ROOM_OPTIONS_CACHE_SIZE, ROOM_OPTIONS_CACHE_TTL, WORKER_ID
+import metrics
 
 logger = logging.getLogger(__name__)
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, Dict[str, Dict[str, WebSocket]]] = {}  # roomId -> {sessionId -> {username: WebSocket}}
-        self.ip_to_users: Dict[str, Dict[str, list]] = {}  # roomId -> {ip: [username]}
-        self.sessions: Dict[str, Dict[str, str]] = {}  # username -> {sessionId: username}
-        self.room_options: Dict[str, dict] = {}  # roomId -> {type: str, max_connections_per_ip: int}
-        self.public_keys: Dict[str, str] = {}  # username -> publicKey
-
-    async def create_session(self, username: str):
-        redis = get_redis()
-        session_id = str(uuid.uuid4())
-        if username not in self.sessions:
-            self.sessions[username] = {}
-        # Kiểm tra Redis trước
-        existing_session = await redis.get(f"session:{username}")
-        if existing_session:
-            session_id = existing_session.decode()
-            self.sessions[username][session_id] = username
-            # logger.info(f"Reused existing session for {username}: {session_id}")
-        else:
-            self.sessions[username][session_id] = username
-            await set_session(username, session_id)
-            # logger.info(f"Created new session for {username}: {session_id}")
-        return session_id
+        self.registry = ConnectionRegistry()  # các kết nối trên worker này, tra cứu theo phòng/user/session
+        self.presence = PresenceBatcher(self.broadcast)
+        # roomId -> {type: str, max_connections_per_ip: int}; cache của "room_options:{roomId}" trong Redis
+        self.room_options = TTLCache(ROOM_OPTIONS_CACHE_SIZE, ROOM_OPTIONS_CACHE_TTL)
+        # Worker khác đổi cấu hình phòng thì xóa bản cache ở worker này
+        broker.on_control("room_options", lambda payload: self.room_options.pop(payload.get("roomId")))
 
     async def set_room_options(self, room_id: str, room_type: str, options: dict = None):
         if options is None:
@@ -42,13 +37,16 @@ class ConnectionManager:
             "max_connections_per_ip": options.get("max_connections_per_ip", 2) if room_type == "private" else None
         }
         redis = get_redis()
-        await redis.set(f"room_options:{room_id}", json.dumps(self.room_options[room_id]))
+        with metrics.redis_seconds.time(op="room_options_set"):
+            await redis.set(f"room_options:{room_id}", json.dumps(self.room_options[room_id]))
+        await broker.publish_control("room_options", {"roomId": room_id})
         # logger.info(f"Set room options for {room_id}: {self.room_options[room_id]}")
 
     async def load_room_options(self, room_id: str):
         room_id = str(room_id)  # Đảm bảo luôn là string
         redis = get_redis()
-        data = await redis.get(f"room_options:{room_id}")
+        with metrics.redis_seconds.time(op="room_options_get"):
+            data = await redis.get(f"room_options:{room_id}")
         if data:
             self.room_options[room_id] = json.loads(data)
             # logger.info(f"Loaded room_options for {room_id} from Redis: {self.room_options[room_id]}")
@@ -56,19 +54,17 @@ class ConnectionManager:
             # logger.warning(f"room_options for {room_id} not found in Redis")
             pass
 
-    async def connect(self, websocket: WebSocket, username: str, client_ip: str, room_id: str):
+    async def connect(self, websocket: WebSocket, username: str, client_ip: str, room_id: str,
+                      binary: bool = False, subprotocol: Optional[str] = None) -> Optional[Connection]:
         room_id = str(room_id)
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = {}
-        if room_id not in self.ip_to_users:
-            self.ip_to_users[room_id] = {}
 
+        # sessionId là JWT; thường lấy thẳng từ cache token đã xác thực, không phải verify chữ ký
         session_id = websocket.query_params.get("sessionId", "")
-        if not session_id or (username not in self.sessions) or (session_id not in self.sessions[username]):
+        if sessions.verify(session_id) != username:
             await websocket.close(code=1008, reason="Invalid session ID.")
-            return False
+            return None
 
-        # Đảm bảo room_options luôn tồn tại
+        # Đảm bảo room_options luôn tồn tại (thường lấy thẳng từ cache, không tốn lượt gọi Redis)
         if room_id not in self.room_options:
             await self.load_room_options(room_id)
             if room_id not in self.room_options:
@@ -76,98 +72,134 @@ class ConnectionManager:
                 await self.set_room_options(room_id, "private", {"max_connections_per_ip": 2})
 
         # Nếu vẫn không có cấu hình phòng, từ chối kết nối
-        if room_id not in self.room_options:
+        options = self.room_options.get(room_id)
+        if options is None:
             await websocket.close(code=1008, reason="Invalid room configuration.")
-            return False
+            return None
 
-        room_type = self.room_options[room_id]["type"]
-        max_connections = self.room_options[room_id].get("max_connections_per_ip", 2)
+        room_type = options["type"]
+        max_connections = options.get("max_connections_per_ip", 2)
+        connection = Connection(room_id, session_id, username, client_ip, websocket)
 
-        # Chỉ kiểm tra số lượng kết nối IP nếu là phòng riêng
+        # Chỉ kiểm tra số lượng kết nối IP nếu là phòng riêng (giới hạn chung cho cả cluster)
         if room_type == "private":
-            current_users = self.ip_to_users.get(room_id, {}).get(client_ip, [])
-            if len(current_users) >= max_connections:
+            slot_id = f"{WORKER_ID}:{uuid.uuid4().hex}"
+            if not await acquire_ip_slot(room_id, client_ip, slot_id, max_connections):
                 await websocket.close(code=1008, reason="Maximum connections reached for this IP.")
-                return False
-
-        await websocket.accept()
-        # Cập nhật ip_to_users sau khi chấp nhận kết nối (chỉ cho phòng riêng)
-        if room_type == "private":
-            self.ip_to_users.setdefault(room_id, {}).setdefault(client_ip, []).append(username)
-        if session_id not in self.active_connections[room_id]:
-            self.active_connections[room_id][session_id] = {}
-        self.active_connections[room_id][session_id][username] = websocket
-        await self.broadcast({"type": "notification", "content": f"{username} has joined the chat", "roomId": room_id}, room_id)
-        await self.broadcast_users(room_id)
-        return True
-
-    async def disconnect(self, websocket: WebSocket, username: str, client_ip: str, room_id: str):
-        session_id = websocket.query_params.get("sessionId", "")
+                return None
+            connection.ip_slot = slot_id
+
+        await websocket.accept(subprotocol=subprotocol)
+        connection.sender = ConnectionSender(websocket, binary)
+        previous = self.registry.add(connection)
+        if previous is not None:
+            # Không xảy ra khi key là duy nhất; nếu có thì đóng hẳn socket cũ để nó không treo nửa sống nửa chết
+            previous.sender.abort("Replaced by a new connection.")
+        else:
+            metrics.active_connections.inc(room=room_id)
+        # Đăng ký vào channel của phòng và danh sách online chung của cluster
+        await broker.join_room(room_id)
+        # Chỉ ghi vào Redis cho kết nối đầu tiên của user trong phòng trên worker này, và chỉ báo "joined"
+        # khi user chưa có kết nối trên worker nào khác
+        if self._local_count(room_id, username) == 1:
+            joined, left = await add_room_user(room_id, username)
+            await self.apply_presence(room_id, [username] if joined else [], left)
+        return connection
+
+    async def disconnect(self, connection: Connection):
+        # Có thể được gọi cả từ chat_ws lẫn từ reaper; chỉ dọn dẹp một lần
+        if not connection.alive:
+            return
+        connection.alive = False
+        room_id, username = connection.room_id, connection.username
+        if self.registry.remove(connection):
+            if self.registry.has_room(room_id):
+                metrics.active_connections.dec(room=room_id)
+            else:
+                metrics.active_connections.remove(room=room_id)
+        connection.sender.close()
+        # Trả lại suất kết nối IP (chỉ có với phòng riêng)
+        if connection.ip_slot:
+            await release_ip_slot(room_id, connection.client_ip, connection.ip_slot)
+            connection.ip_slot = None
+        # Hủy subscribe khi worker không còn socket nào trong phòng
+        if not self.registry.has_room(room_id):
+            await broker.leave_room(room_id)
+        if self._local_count(room_id, username) == 0:
+            gone, left = await remove_room_user(room_id, username)
+            await self.apply_presence(room_id, [], left + [username] if gone else left)
+
+    def _local_count(self, room_id: str, username: str) -> int:
+        return len(self.registry.of_user(room_id, username))
+
+    async def apply_presence(self, room_id: str, joined: list, left: list):
+        for username in joined:
+            self.presence.joined(room_id, username)
+        for username in left:
+            self.presence.left(room_id, username)
+            # User đã rời phòng trên toàn cluster: bỏ publicKey khỏi danh bạ của phòng
+            await remove_key(room_id, username)
+
+    async def refresh_presence(self, batch_size: int):
+        # Gia hạn entry online của các user có kết nối trên worker này (gọi từ heartbeat). Kết quả trả về
+        # cả những user của worker chết đã hết hạn, và user của worker này bị dọn nhầm (worker treo quá lâu)
+        rooms = {}
+        for connection in list(self.registry.all()):
+            rooms.setdefault(connection.room_id, set()).add(connection.username)
+        items = [(room_id, list(usernames)) for room_id, usernames in rooms.items()]
+        for i in range(0, len(items), batch_size):
+            changes = await refresh_room_users(dict(items[i:i + batch_size]))
+            for room_id, (joined, left) in changes.items():
+                await self.apply_presence(room_id, joined, left)
+
+    async def broadcast(self, message, room_id: str):
+        # message có thể là dict hoặc Frame đã encode sẵn; mọi nơi nhận dùng chung một bản encode
         room_id = str(room_id)
-        if room_id in self.active_connections and session_id in self.active_connections[room_id] and username in self.active_connections[room_id][session_id]:
-            del self.active_connections[room_id][session_id][username]
-            if not self.active_connections[room_id][session_id]:
-                del self.active_connections[room_id][session_id]
-            # Chỉ xóa user khỏi ip_to_users nếu là phòng riêng
-            room_type = self.room_options.get(room_id, {}).get("type", "private")
-            if room_type == "private":
-                if room_id in self.ip_to_users and client_ip in self.ip_to_users[room_id] and username in self.ip_to_users[room_id][client_ip]:
-                    self.ip_to_users[room_id][client_ip].remove(username)
-                    if not self.ip_to_users[room_id][client_ip]:
-                        del self.ip_to_users[room_id][client_ip]
-                await remove_user_from_ip(client_ip, username)
-            if username in self.sessions and session_id in self.sessions[username]:
-                del self.sessions[username][session_id]
-                if not self.sessions[username]:
-                    del self.sessions[username]
-            await self.broadcast({"type": "notification", "content": f"{username} has left the chat", "roomId": room_id}, room_id)
-            await self.broadcast_users(room_id)
-
-    async def broadcast(self, message: dict, room_id: str):
-        # Hỗ trợ gửi tin nhắn riêng
+        frame = Frame.of(message)
+        # Gửi cho socket trên worker này, sau đó publish một lần cho các worker khác
+        await self.deliver_local(room_id, frame)
+        await broker.publish(room_id, frame)
+        return frame
+
+    async def remap_ids(self, room_id: str, ids: dict):
+        # Redis đã lưu tin với id khác id tạm đã gửi đi (lệch đồng hồ giữa các worker): báo client sửa lại
+        # để lastSeenId và việc lọc trùng theo id khớp với lịch sử trong Redis
+        await self.broadcast({"type": "ids", "roomId": room_id, "ids": ids}, room_id)
+
+    async def deliver_local(self, room_id: str, frame: Frame):
+        # Chỉ xếp tin nhắn vào hàng đợi của từng kết nối, không await client nào
+        with metrics.broadcast_seconds.time(), metrics.profiled("broadcast"):
+            metrics.broadcast_recipients.inc(self._deliver(room_id, frame))
+
+    def _deliver(self, room_id: str, frame: Frame) -> int:
+        message = frame.message
+        sent = 0
+        # Hỗ trợ gửi tin nhắn riêng: tra thẳng các kết nối của người nhận
         if message.get("type") == "private_message":
             target_username = message.get("to")
             if not target_username:
-                return
-            for session_id, users in self.active_connections.get(room_id, {}).items():
-                if target_username in users:
-                    await users[target_username].send_json(message)
-                    break
-            return
-        if room_id in self.active_connections:
-            sender_username = message.get("username")
-            room_id = message.get("RoomId", room_id)  # Đảm bảo roomId từ message được ưu tiên
-            to_remove = []
-            for session_id in list(self.active_connections[room_id].keys()):
-                for user, ws in list(self.active_connections[room_id][session_id].items()):
-                    # Không gửi lại publicKey cho người gửi
-                    if message.get("type") == "publicKey" and user == sender_username:
-                        continue
-                    try:
-                        await ws.send_json(message)
-                        # logger.debug(f"Sent to {user} in room {room_id}: {message}")
-                    except Exception as e:
-                        # logger.error(f"Broadcast failed for {user}: {e}")
-                        # Xóa reference WebSocket đã đóng
-                        to_remove.append((session_id, user, ws))
-            # Xóa các WebSocket đã đóng khỏi active_connections
-            for session_id, user, ws in to_remove:
-                if session_id in self.active_connections[room_id] and user in self.active_connections[room_id][session_id]:
-                    del self.active_connections[room_id][session_id][user]
-                    # logger.info(f"Removed closed WebSocket for {user} in room {room_id}")
-                # Nếu session_id không còn user nào, xóa luôn session_id
-                if session_id in self.active_connections[room_id] and not self.active_connections[room_id][session_id]:
-                    del self.active_connections[room_id][session_id]
-
-    async def broadcast_users(self, room_id: str):
-        if room_id in self.active_connections:
-            users = set()  # Sử dụng set để loại bỏ trùng lặp
-            for session_id in self.active_connections[room_id]:
-                users.update(self.active_connections[room_id][session_id].keys())
-            await self.broadcast({"type": "users", "users": list(users), "roomId": room_id}, room_id)
-
-    def store_public_key(self, username: str, public_key: str):
-        self.public_keys[username] = public_key
-        # logger.info(f"Stored public key for {username}")
+                return 0
+            for connection in self.registry.of_user(room_id, target_username):
+                sent += connection.sender.send(frame)
+            return sent
+        room_id = message.get("RoomId", room_id)  # Đảm bảo roomId từ message được ưu tiên
+        sender_username = message.get("username")
+        skip_sender = message.get("type") == "publicKey"
+        for connection in self.registry.in_room(room_id):
+            # Không gửi lại publicKey cho người gửi
+            if skip_sender and connection.username == sender_username:
+                continue
+            sent += connection.sender.send(frame)
+        return sent
+
+    def send_personal(self, connection: Connection, message):
+        # Gửi qua cùng hàng đợi với broadcast để giữ đúng thứ tự tin nhắn
+        connection.sender.send(Frame.of(message))
+
+    async def send_users(self, connection: Connection):
+        # Danh sách online đầy đủ (lấy từ Redis để bao gồm user trên mọi worker), chỉ gửi cho một kết nối:
+        # lúc mới vào phòng hoặc khi client yêu cầu; sau đó client tự cập nhật theo các tin "presence"
+        users = await get_room_users(connection.room_id)
+        self.send_personal(connection, {"type": "users", "users": users, "roomId": connection.room_id})
 
 manager = ConnectionManager()
\ No newline at end of file
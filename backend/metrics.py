@@ -0,0 +1,184 @@
+# ./metrics.py
+import cProfile
+import io
+import pstats
+import random
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+from config import PROFILE_SAMPLE_RATE
+
+# Metric kiểu Prometheus, đủ rẻ để luôn bật: mỗi lần ghi chỉ là một phép cộng vào dict trong process.
+# Mỗi worker có bộ đếm riêng; Prometheus gom lại theo instance.
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: dict) -> LabelKey:
+    if not labels:
+        return ()
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[LabelKey, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0)
+
+    def remove(self, **labels):
+        # Bỏ series không còn dùng (ví dụ phòng đã trống) để số series không tăng mãi
+        self.values.pop(_label_key(labels), None)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self.values[_label_key(labels)] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.values: Dict[LabelKey, list] = {}  # key -> [số lần theo bucket..., tổng, số lần]
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        item = self.values.get(key)
+        if item is None:
+            item = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        item[bisect_left(self.buckets, value)] += 1
+        item[-2] += value
+        item[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, item in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], item):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {item[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {item[-1]}")
+        return lines
+
+
+REGISTRY: list = []
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Profiler lấy mẫu: chỉ bật khi PROFILE_SAMPLE_RATE > 0, khi đó cứ khoảng 1/rate lượt chạy của một đoạn
+# code nóng (broadcast, vòng nhận tin) sẽ được đo bằng cProfile và cộng dồn theo tên đoạn.
+# Chỉ bao quanh code đồng bộ: nếu đoạn được đo có await, cProfile vẫn bật trong lúc coroutine tạm dừng
+# và ghi cả các task khác, đồng thời chặn mẫu của các đoạn khác trong thời gian đó.
+_profiles: Dict[str, pstats.Stats] = {}
+_profiling = False
+
+
+@contextmanager
+def profiled(section: str):
+    global _profiling
+    if PROFILE_SAMPLE_RATE <= 0 or _profiling or random.random() >= PROFILE_SAMPLE_RATE:
+        yield
+        return
+    _profiling = True
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _profiling = False
+        if section in _profiles:
+            _profiles[section].add(profile)
+        else:
+            _profiles[section] = pstats.Stats(profile)
+
+
+def profile_report(section: Optional[str] = None, limit: int = 30) -> str:
+    out = io.StringIO()
+    for name, stats in _profiles.items():
+        if section and name != section:
+            continue
+        out.write(f"=== {name} ===\n")
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(limit)
+    return out.getvalue() or "No samples collected (set PROFILE_SAMPLE_RATE > 0).\n"
+
+
+send_queue_depth = Gauge("chat_send_queue_depth", "Messages waiting in per-connection send queues")
+send_queue_max_depth = Gauge("chat_send_queue_max_depth", "Deepest per-connection send queue seen")
+send_dropped = Counter("chat_send_dropped_total", "Outbound messages dropped for slow consumers")
+slow_consumers = Counter("chat_slow_consumers_total", "Connections closed for falling behind")
+send_failures = Counter("chat_send_failures_total", "WebSocket sends that raised an error")
+persist_pending = Gauge("chat_persist_pending", "Messages waiting to be written to Redis")
+persist_batches = Counter("chat_persist_batches_total", "Pipelined history write batches")
+persist_failures = Counter("chat_persist_failures_total", "Messages that could not be written to Redis")
+active_connections = Gauge("chat_active_connections", "Open WebSocket connections on this worker by room")
+broadcast_seconds = Histogram("chat_broadcast_fanout_seconds", "Time to queue one message for every local recipient", LATENCY_BUCKETS)
+broadcast_recipients = Counter("chat_broadcast_recipients_total", "Frames queued by broadcasts")
+redis_seconds = Histogram("chat_redis_command_seconds", "Redis round-trip latency by operation", LATENCY_BUCKETS)
+history_bytes = Histogram("chat_history_payload_bytes", "Encoded size of history/replay payloads", SIZE_BUCKETS)
+jwt_seconds = Histogram("chat_jwt_verify_seconds", "Time spent verifying session token signatures", LATENCY_BUCKETS)
+session_cache_hits = Counter("chat_session_cache_hits_total", "Session tokens accepted from the verified-token cache")
+reaped_connections = Counter("chat_reaped_connections_total", "Connections closed by the idle-timeout reaper")
+rate_limited = Counter("chat_rate_limited_total", "Messages rejected by the rate limiter")
+ring_nodes = Gauge("chat_ring_nodes", "Nodes in the room-sharding hash ring")
+handoffs = Counter("chat_handoffs_total", "Connections redirected to another node after the hash ring changed")
+archived_messages = Counter("chat_archived_messages_total", "Messages moved from Redis to on-disk archive segments")
+archive_bytes = Counter("chat_archive_bytes_total", "Compressed bytes appended to archive segments")
+archive_read_seconds = Histogram("chat_archive_read_seconds", "Time to read history pages from archive segments", LATENCY_BUCKETS)
@@ -0,0 +1,113 @@
+# ./migrate_history.py
+"""Chuyển lịch sử cũ từ Redis list "chat:{roomId}" sang Redis Stream "chat_stream:{roomId}".
+
+Chạy một lần sau khi nâng cấp (có thể chạy khi server đang chạy):
+
+    python migrate_history.py            # chuyển mọi phòng
+    python migrate_history.py --dry-run  # chỉ liệt kê số tin mỗi phòng
+
+Tin cũ được đặt trước các tin đã có trong stream, id lấy theo timestamp của tin (luôn nhỏ hơn id
+đầu tiên của stream). List cũ được đổi tên thành "chat_migrated:{roomId}" để có thể xóa sau khi kiểm tra.
+"""
+import argparse
+import asyncio
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+from redis_client import init_redis, get_redis
+from history import stream_key, _id_tuple
+from config import REDIS_CHANNEL, HISTORY_MAX_LEN, ARCHIVE_ENABLED
+from serialization import loads
+
+BATCH = 1000
+
+
+def migrating_key(room_id: str) -> str:
+    # Stream tạm khi đang ghép; nằm ngoài "chat_stream:*" để archiver (chạy cùng lúc) không lưu trữ và cắt nó
+    return f"{REDIS_CHANNEL}_migrating:{room_id}"
+
+# Chép nốt các entry được ghi vào stream trong lúc đang chuyển rồi thay stream bằng bản đã ghép,
+# tất cả trong một script nên không mất tin mới
+_FINISH_SCRIPT = """
+local rest = redis.call('XRANGE', KEYS[2], '(' .. ARGV[1], '+')
+for _, entry in ipairs(rest) do
+    redis.call('XADD', KEYS[1], entry[1], unpack(entry[2]))
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+redis.call('RENAME', KEYS[3], KEYS[4])
+return #rest
+"""
+
+
+def _timestamp_ms(text: str) -> Optional[int]:
+    try:
+        timestamp = loads(text).get("timestamp")
+        moment = datetime.fromisoformat(str(timestamp).replace("Z", "+00:00"))
+    except Exception:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)  # server cũ ghi datetime.utcnow()
+    return int(moment.timestamp() * 1000)
+
+
+def assign_ids(texts: List[str], first_id: Optional[str]) -> List[Tuple[str, str]]:
+    # ID tăng dần theo thứ tự trong list; timestamp lệch/không đọc được thì dùng lại ms của tin trước
+    limit = _id_tuple(first_id)[0] - 1 if first_id else None
+    last_ms, last_seq = 0, -1
+    entries = []
+    for text in texts:
+        ms = _timestamp_ms(text) or last_ms
+        if limit is not None:
+            ms = min(ms, limit)
+        if ms <= last_ms:
+            last_seq += 1
+        else:
+            last_ms, last_seq = ms, 0
+        entries.append((f"{last_ms}-{last_seq}", text))
+    return entries
+
+
+async def migrate_room(list_key: str, dry_run: bool = False) -> int:
+    redis = get_redis()
+    room_id = list_key[len(REDIS_CHANNEL) + 1:]
+    key = stream_key(room_id)
+    # Không lưu trữ ra đĩa thì stream chỉ giữ HISTORY_MAX_LEN tin, chuyển nhiều hơn cũng bị cắt
+    start = 0 if ARCHIVE_ENABLED else -HISTORY_MAX_LEN
+    texts = await redis.lrange(list_key, start, -1)
+    if dry_run or not texts:
+        return len(texts)
+    existing = await redis.xrange(key, min="-", max="+")
+    entries = assign_ids(texts, existing[0][0] if existing else None)
+    temp = migrating_key(room_id)
+    await redis.delete(temp)
+    for i in range(0, len(entries), BATCH):
+        async with redis.pipeline(transaction=False) as pipe:
+            for entry_id, text in entries[i:i + BATCH]:
+                pipe.xadd(temp, {"d": text}, id=entry_id)
+            await pipe.execute()
+    for i in range(0, len(existing), BATCH):
+        async with redis.pipeline(transaction=False) as pipe:
+            for entry_id, fields in existing[i:i + BATCH]:
+                pipe.xadd(temp, fields, id=entry_id)
+            await pipe.execute()
+    last_copied = existing[-1][0] if existing else "0-0"
+    await redis.eval(_FINISH_SCRIPT, 4, temp, key, list_key, f"{REDIS_CHANNEL}_migrated:{room_id}", last_copied)
+    return len(texts)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="chỉ đếm, không ghi gì vào Redis")
+    args = parser.parse_args()
+    await init_redis()
+    total = 0
+    async for list_key in get_redis().scan_iter(match=f"{REDIS_CHANNEL}:*", count=500, _type="LIST"):
+        count = await migrate_room(list_key, args.dry_run)
+        print(f"{list_key}: {count} messages")
+        total += count
+    print(f"Total: {total} messages{' (dry run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
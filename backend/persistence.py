@@ -0,0 +1,124 @@
+# ./persistence.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from redis_client import get_redis
+from config import PERSIST_BATCH_SIZE, PERSIST_FLUSH_INTERVAL, PERSIST_MAX_PENDING, PERSIST_RETRIES
+from history import append_messages
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# (room_id, message_id, text, future) — future chỉ có khi người gọi cần chờ Redis xác nhận
+PendingWrite = Tuple[str, str, str, Optional[asyncio.Future]]
+
+
+class PersistenceQueue:
+    """Ghi lịch sử theo lô (write-behind) để Redis không nằm trên đường broadcast.
+
+    Tin nhắn được gom theo phòng và gửi trong một pipeline khi đủ PERSIST_BATCH_SIZE
+    tin hoặc sau PERSIST_FLUSH_INTERVAL giây. Hàng đợi có giới hạn nên khi Redis chậm,
+    append() sẽ phải chờ thay vì để bộ nhớ tăng mãi.
+    """
+
+    def __init__(self, batch_size: int = PERSIST_BATCH_SIZE, flush_interval: float = PERSIST_FLUSH_INTERVAL,
+                 max_pending: int = PERSIST_MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.task: Optional[asyncio.Task] = None
+        self.on_remap = None
+
+    def start(self, on_remap: Optional[Callable[[str, Dict[str, str]], Awaitable[None]]] = None):
+        # on_remap(room_id, {id tạm: id thật}) được gọi khi Redis phải tự cấp id cho tin đã broadcast
+        self.on_remap = on_remap
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Không hủy task giữa lúc đang ghi một lô: xếp None vào cuối hàng đợi để vòng ghi
+        # ghi nốt mọi tin trước nó rồi tự dừng
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def append(self, room_id: str, message_id: str, text: str, durable: bool = False) -> Optional[str]:
+        """Xếp tin nhắn vào hàng đợi ghi; với durable=True thì chờ đến khi Redis ghi xong và trả về id thật."""
+        future = asyncio.get_running_loop().create_future() if durable else None
+        await self.queue.put((str(room_id), message_id, text, future))
+        metrics.persist_pending.inc()
+        if future is not None:
+            return await future
+        return None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    item = self.queue.get_nowait()
+                else:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[PendingWrite]):
+        # Gom theo phòng, giữ nguyên thứ tự tin nhắn trong từng phòng
+        rooms: Dict[str, List[PendingWrite]] = {}
+        for item in batch:
+            rooms.setdefault(item[0], []).append(item)
+        metrics.persist_pending.dec(len(batch))
+        metrics.persist_batches.inc()
+
+        for attempt in range(PERSIST_RETRIES):
+            try:
+                with metrics.redis_seconds.time(op="history_append"):
+                    async with get_redis().pipeline(transaction=False) as pipe:
+                        for room_id, items in rooms.items():
+                            await append_messages(room_id, [(item[1], item[2]) for item in items], client=pipe,
+                                                  retry=attempt > 0)
+                        results = await pipe.execute()
+                break
+            except Exception as e:
+                logger.error(f"Persist batch failed (attempt {attempt + 1}): {e}")
+                if attempt + 1 == PERSIST_RETRIES:
+                    metrics.persist_failures.inc(len(batch))
+                    for item in batch:
+                        if item[3] is not None and not item[3].done():
+                            item[3].set_exception(e)
+                    return
+                await asyncio.sleep(0.1 * (attempt + 1))
+
+        remapped: Dict[str, Dict[str, str]] = {}
+        for (room_id, items), ids in zip(rooms.items(), results):
+            for item, entry_id in zip(items, ids):
+                if item[3] is not None:
+                    if not item[3].done():
+                        item[3].set_result(entry_id)
+                elif entry_id != item[1]:
+                    # Tin đã được broadcast với id tạm nhưng Redis lưu với id khác
+                    remapped.setdefault(room_id, {})[item[1]] = entry_id
+        if remapped and self.on_remap is not None:
+            for room_id, ids in remapped.items():
+                try:
+                    await self.on_remap(room_id, ids)
+                except Exception as e:
+                    logger.error(f"Id remap failed: {e}")
+
+
+persistence = PersistenceQueue()
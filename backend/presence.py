@@ -0,0 +1,78 @@
+# ./presence.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List
+from config import PRESENCE_WINDOW, PRESENCE_NOTIFY_NAMES
+
+logger = logging.getLogger(__name__)
+
+BroadcastFunc = Callable[[dict, str], Awaitable[object]]
+
+
+class _RoomDelta:
+    __slots__ = ("joined", "left")
+
+    def __init__(self):
+        # dict thay cho set để giữ thứ tự sự kiện
+        self.joined: Dict[str, None] = {}
+        self.left: Dict[str, None] = {}
+
+
+class PresenceBatcher:
+    """Gom các lượt vào/rời phòng trong PRESENCE_WINDOW giây rồi gửi một lần.
+
+    Thay vì gửi cả danh sách online cho mọi thành viên ở mỗi lượt vào/rời (O(N²) khi N người
+    cùng vào), mỗi cửa sổ chỉ gửi một tin "presence" chứa phần thay đổi và một thông báo gộp.
+    Vào rồi rời (hoặc rời rồi vào) trong cùng cửa sổ thì triệt tiêu nhau.
+    """
+
+    def __init__(self, broadcast: BroadcastFunc, window: float = PRESENCE_WINDOW):
+        self.broadcast = broadcast
+        self.window = window
+        self.pending: Dict[str, _RoomDelta] = {}
+
+    def joined(self, room_id: str, username: str):
+        delta = self._delta(room_id)
+        if username in delta.left:
+            del delta.left[username]
+        else:
+            delta.joined[username] = None
+
+    def left(self, room_id: str, username: str):
+        delta = self._delta(room_id)
+        if username in delta.joined:
+            del delta.joined[username]
+        else:
+            delta.left[username] = None
+
+    def _delta(self, room_id: str) -> _RoomDelta:
+        delta = self.pending.get(room_id)
+        if delta is None:
+            delta = self.pending[room_id] = _RoomDelta()
+            asyncio.create_task(self._flush_later(room_id))
+        return delta
+
+    async def _flush_later(self, room_id: str):
+        await asyncio.sleep(self.window)
+        delta = self.pending.pop(room_id, None)
+        if delta is None or not (delta.joined or delta.left):
+            return
+        joined, left = list(delta.joined), list(delta.left)
+        try:
+            await self.broadcast({"type": "presence", "joined": joined, "left": left, "roomId": room_id}, room_id)
+            if joined:
+                await self.broadcast({"type": "notification", "content": f"{_names(joined)} {'has' if len(joined) == 1 else 'have'} joined the chat", "roomId": room_id}, room_id)
+            if left:
+                await self.broadcast({"type": "notification", "content": f"{_names(left)} {'has' if len(left) == 1 else 'have'} left the chat", "roomId": room_id}, room_id)
+        except Exception as e:
+            logger.error(f"Presence flush failed for room {room_id}: {e}")
+
+
+def _names(usernames: List[str]) -> str:
+    if len(usernames) == 1:
+        return usernames[0]
+    shown = usernames[:PRESENCE_NOTIFY_NAMES]
+    others = len(usernames) - len(shown)
+    if others == 0:
+        return ", ".join(shown[:-1]) + " and " + shown[-1]
+    return ", ".join(shown) + f" and {others} other{'s' if others > 1 else ''}"
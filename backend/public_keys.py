@@ -0,0 +1,91 @@
+# ./public_keys.py
+from typing import Tuple
+from redis_client import get_redis
+from config import PUBLIC_KEY_TOMBSTONES
+import metrics
+
+# Danh bạ publicKey của mỗi phòng trong Redis, mọi worker dùng chung:
+#   pubkeys:{roomId}       hash username -> publicKey
+#   pubkeys_ver:{roomId}   sorted set username -> version lần đổi key cuối
+#   pubkeys_gone:{roomId}  sorted set username -> version lúc rời phòng (dấu xóa)
+#   pubkeys_meta:{roomId}  hash: seq (version mới nhất), floor (version của dấu xóa cũ nhất đã bị bỏ)
+# Client giữ version đã đồng bộ và chỉ lấy phần thay đổi sau version đó.
+
+_STORE_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return {tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]) or 0), 0}
+end
+local v = redis.call('HINCRBY', KEYS[4], 'seq', 1)
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[2], v, ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+return {v, 1}
+"""
+
+_REMOVE_SCRIPT = """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+local v = redis.call('HINCRBY', KEYS[4], 'seq', 1)
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[3], v, ARGV[1])
+local extra = redis.call('ZCARD', KEYS[3]) - tonumber(ARGV[2])
+if extra > 0 then
+    local dropped = redis.call('ZRANGE', KEYS[3], extra - 1, extra - 1, 'WITHSCORES')
+    redis.call('ZREMRANGEBYRANK', KEYS[3], 0, extra - 1)
+    redis.call('HSET', KEYS[4], 'floor', dropped[2])
+end
+return v
+"""
+
+_FETCH_SCRIPT = """
+local since = tonumber(ARGV[1])
+local seq = tonumber(redis.call('HGET', KEYS[4], 'seq') or 0)
+local floor = tonumber(redis.call('HGET', KEYS[4], 'floor') or 0)
+if since <= 0 or since < floor or since > seq then
+    return {seq, 1, redis.call('HGETALL', KEYS[1]), {}}
+end
+local changed = {}
+for _, user in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '(' .. since, '+inf')) do
+    changed[#changed + 1] = user
+    changed[#changed + 1] = redis.call('HGET', KEYS[1], user)
+end
+return {seq, 0, changed, redis.call('ZRANGEBYSCORE', KEYS[3], '(' .. since, '+inf')}
+"""
+
+_scripts = {}
+
+
+def _script(name: str, source: str):
+    if name not in _scripts:
+        _scripts[name] = get_redis().register_script(source)
+    return _scripts[name]
+
+
+def _keys(room_id: str) -> list:
+    return [f"pubkeys:{room_id}", f"pubkeys_ver:{room_id}", f"pubkeys_gone:{room_id}", f"pubkeys_meta:{room_id}"]
+
+
+async def store_key(room_id: str, username: str, public_key: str) -> Tuple[int, bool]:
+    """Lưu publicKey của user; trả về (version, key có thay đổi hay không)."""
+    with metrics.redis_seconds.time(op="public_key_store"):
+        version, changed = await _script("store", _STORE_SCRIPT)(keys=_keys(room_id), args=[username, public_key])
+    return int(version), bool(changed)
+
+
+async def remove_key(room_id: str, username: str) -> int:
+    with metrics.redis_seconds.time(op="public_key_remove"):
+        return int(await _script("remove", _REMOVE_SCRIPT)(keys=_keys(room_id), args=[username, PUBLIC_KEY_TOMBSTONES]))
+
+
+async def fetch_keys(room_id: str, since: int = 0) -> dict:
+    """Các publicKey đã đổi sau version `since` (full=True: toàn bộ danh bạ, client thay hẳn bản đang có)."""
+    with metrics.redis_seconds.time(op="public_key_fetch"):
+        version, full, pairs, removed = await _script("fetch", _FETCH_SCRIPT)(keys=_keys(room_id), args=[since])
+    return {
+        "roomId": room_id,
+        "version": int(version),
+        "full": bool(full),
+        "keys": dict(zip(pairs[::2], pairs[1::2])),
+        "removed": removed,
+    }
@@ -0,0 +1,116 @@
+# ./pubsub.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Set
+from redis_client import get_redis
+from config import REDIS_PUBSUB_PREFIX, WORKER_ID
+from serialization import Frame, dumps, loads
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CONTROL_CHANNEL = f"{REDIS_PUBSUB_PREFIX}:__control__"
+
+# handler(room_id, frame) -> giao tin nhắn cho các socket cục bộ
+MessageHandler = Callable[[str, Frame], Awaitable[None]]
+# handler(payload) cho các tín hiệu điều khiển, ví dụ báo xóa cache
+ControlHandler = Callable[[dict], None]
+
+
+class RoomBroker:
+    """Fan-out giữa các worker qua Redis pub/sub, mỗi phòng một channel.
+
+    Worker chỉ subscribe những phòng đang có socket cục bộ, publish một lần
+    cho mỗi tin nhắn và bỏ qua tin nhắn do chính nó gửi.
+    """
+
+    def __init__(self):
+        self.pubsub = None
+        self.listener: Optional[asyncio.Task] = None
+        self.handler: Optional[MessageHandler] = None
+        self.rooms: Set[str] = set()  # các phòng worker này đang subscribe
+        self.control_handlers: Dict[str, ControlHandler] = {}  # kind -> handler
+
+    @staticmethod
+    def channel(room_id: str) -> str:
+        return f"{REDIS_PUBSUB_PREFIX}:{room_id}"
+
+    async def start(self, handler: MessageHandler):
+        self.handler = handler
+        self.pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        # Luôn subscribe channel điều khiển để listen() không kết thúc khi chưa có phòng nào
+        await self.pubsub.subscribe(CONTROL_CHANNEL)
+        self.listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.listener:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+        if self.pubsub:
+            await self.pubsub.aclose()
+            self.pubsub = None
+        self.rooms.clear()
+
+    async def join_room(self, room_id: str):
+        room_id = str(room_id)
+        if room_id in self.rooms or self.pubsub is None:
+            return
+        self.rooms.add(room_id)
+        await self.pubsub.subscribe(self.channel(room_id))
+
+    async def leave_room(self, room_id: str):
+        room_id = str(room_id)
+        if room_id not in self.rooms or self.pubsub is None:
+            return
+        self.rooms.discard(room_id)
+        await self.pubsub.unsubscribe(self.channel(room_id))
+
+    async def publish(self, room_id: str, frame: Frame):
+        # Envelope = "<worker id>\n<frame JSON>", tái sử dụng frame đã encode thay vì bọc lại bằng JSON
+        with metrics.redis_seconds.time(op="publish"):
+            await get_redis().publish(self.channel(room_id), f"{WORKER_ID}\n{frame.text}")
+
+    def on_control(self, kind: str, handler: ControlHandler):
+        self.control_handlers[kind] = handler
+
+    async def publish_control(self, kind: str, payload: dict = None):
+        body = dumps({"kind": kind, "payload": payload or {}})
+        await get_redis().publish(CONTROL_CHANNEL, f"{WORKER_ID}\n{body}")
+
+    async def _listen(self):
+        while True:
+            try:
+                async for item in self.pubsub.listen():
+                    try:
+                        await self._dispatch(item)
+                    except Exception as e:
+                        logger.error(f"Pub/sub dispatch failed: {e}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Pub/sub listener error: {e}")
+                await asyncio.sleep(1)
+
+    async def _dispatch(self, item: dict):
+        if item.get("type") != "message":
+            return
+        origin, _, text = item["data"].partition("\n")
+        if origin == WORKER_ID:
+            return
+        if item["channel"] == CONTROL_CHANNEL:
+            control = loads(text)
+            handler = self.control_handlers.get(control.get("kind"))
+            if handler:
+                handler(control.get("payload", {}))
+            return
+        room_id = item["channel"][len(REDIS_PUBSUB_PREFIX) + 1:]
+        if room_id in self.rooms and self.handler:
+            # Giải mã một lần để định tuyến, gửi lại nguyên văn bản đã encode cho các socket
+            await self.handler(room_id, Frame(loads(text), text))
+
+
+broker = RoomBroker()
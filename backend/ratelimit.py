@@ -0,0 +1,128 @@
+# ./ratelimit.py
+import logging
+import time
+from typing import List, Tuple
+from redis_client import get_redis
+from cache import TTLCache
+from config import (RATE_USER, RATE_USER_BURST, RATE_IP, RATE_IP_BURST, RATE_ROOM, RATE_ROOM_BURST,
+                    RATE_CONTROL, RATE_CONTROL_BURST, RATE_LEASE_MAX, RATE_LEASE_TTL)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Token bucket trong Redis, hash "ratelimit:{scope}:{id}" gồm số token còn lại (t) và thời điểm nạp cuối (ts).
+# Một lần gọi kiểm tra mọi bucket (user, IP, phòng) và lấy cùng số token ở tất cả, tối đa ARGV[1] token;
+# trả về {số token được cấp, số ms cần chờ nếu không được cấp}. Dùng đồng hồ của Redis để mọi worker thống nhất.
+_TAKE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local grant = tonumber(ARGV[1])
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 't', 'ts')
+    local t = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    t = math.min(burst, t + math.max(0, now - ts) * rate / 1000)
+    tokens[i] = t
+    if math.floor(t) < grant then
+        grant = math.floor(t)
+    end
+    if t < 1 then
+        wait = math.max(wait, math.ceil((1 - t) * 1000 / rate))
+    end
+end
+if grant < 1 then
+    return {0, wait}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', key, 't', tokens[i] - grant, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return {grant, 0}
+"""
+
+# Các bucket mặc định: (scope, trường định danh, rate, burst)
+MESSAGE_LIMITS = (("user", "user", RATE_USER, RATE_USER_BURST),
+                  ("ip", "ip", RATE_IP, RATE_IP_BURST),
+                  ("room", "room", RATE_ROOM, RATE_ROOM_BURST))
+# Frame điều khiển (publicKey, getKeys, users) dùng bucket riêng theo user, không ăn vào hạn mức gửi tin
+CONTROL_LIMITS = (("control", "user", RATE_CONTROL, RATE_CONTROL_BURST),)
+
+
+class _Lease:
+    __slots__ = ("tokens", "size", "expires_at")
+
+    def __init__(self, tokens: int, size: int, expires_at: float):
+        self.tokens = tokens
+        self.size = size
+        self.expires_at = expires_at
+
+
+class RateLimiter:
+    """Giới hạn tốc độ theo user, IP và phòng, dùng chung cho cả cluster.
+
+    Đường nhanh: worker giữ một "lease" token đã lấy trước từ Redis cho mỗi (user, IP, phòng),
+    nên client gửi liên tục chỉ chạm Redis khi hết lease. Lease tăng gấp đôi khi bị dùng hết
+    trước hạn và giảm đi khi hết hạn, nên client gửi thưa không giữ token thừa của phòng.
+    """
+
+    def __init__(self, limits=MESSAGE_LIMITS, lease_max: int = RATE_LEASE_MAX, lease_ttl: float = RATE_LEASE_TTL):
+        self.limits = limits
+        self.lease_max = max(1, lease_max)
+        self.lease_ttl = lease_ttl
+        self.leases = TTLCache(maxsize=100000, ttl=lease_ttl * 4)
+        self.script = None
+
+    def _buckets(self, username: str, ip: str, room_id: str) -> Tuple[List[str], list]:
+        values = {"user": username, "ip": ip, "room": room_id}
+        keys, args = [], []
+        for scope, field, rate, burst in self.limits:
+            if rate > 0:
+                keys.append(f"ratelimit:{scope}:{values[field]}")
+                args += [rate, max(1, burst)]
+        return keys, args
+
+    async def acquire(self, username: str, ip: str, room_id: str) -> float:
+        """Lấy một token; trả về 0 nếu được gửi, ngược lại là số giây nên chờ trước khi thử lại."""
+        key = (username, ip, room_id)
+        now = time.monotonic()
+        lease = self.leases.get(key)
+        if lease is not None and lease.tokens > 0 and lease.expires_at > now:
+            lease.tokens -= 1
+            return 0.0
+
+        keys, args = self._buckets(username, ip, room_id)
+        if not keys:
+            return 0.0
+        if lease is None:
+            size = 1
+        elif lease.expires_at > now:
+            size = min(lease.size * 2, self.lease_max)
+        else:
+            size = max(1, lease.size // 2)
+
+        if self.script is None:
+            self.script = get_redis().register_script(_TAKE_SCRIPT)
+        try:
+            with metrics.redis_seconds.time(op="rate_limit"):
+                granted, wait_ms = await self.script(keys=keys, args=[size] + args)
+        except Exception as e:
+            # Redis lỗi thì cho qua, không chặn chat chỉ vì không đếm được
+            logger.error(f"Rate limit check failed: {e}")
+            return 0.0
+
+        granted = int(granted)
+        if granted < 1:
+            self.leases.set(key, _Lease(0, 1, now))
+            return max(int(wait_ms), 1) / 1000
+        self.leases.set(key, _Lease(granted - 1, size, now + self.lease_ttl))
+        return 0.0
+
+
+rate_limiter = RateLimiter()
+control_limiter = RateLimiter(CONTROL_LIMITS)
@@ -1,7 +1,9 @@
 # ./redis_client.py
 import redis.asyncio as redis
-from config import REDIS_HOST, REDIS_PORT
+from typing import Dict, List, Tuple
+from config import REDIS_HOST, REDIS_PORT, IP_SLOT_TTL, PRESENCE_TTL, WORKER_ID
 import logging
+import metrics
 
 redis_client: redis.Redis = None
 
@@ -15,38 +17,169 @@ def get_redis():
         raise RuntimeError("Redis client not initialized")
     return redis_client
 
-async def add_user_to_ip(ip: str, username: str, max_connections: int = 2) -> bool:
-    redis = get_redis()
-    key = f"ip_users:{ip}"
-    current_users = await redis.lrange(key, 0, -1)
-    current_count = len(current_users)
+# Giới hạn kết nối theo IP cho từng phòng, dùng chung cho mọi worker: sorted set
+# "ip_conn:{roomId}:{ip}" gồm id các kết nối, score là thời điểm hết hạn (ms).
+# Kiểm tra và ghi trong cùng một script nên chỉ tốn một lượt gọi Redis và không bị race khi nhiều
+# kết nối cùng vào; kết nối của worker chết tự hết hạn sau IP_SLOT_TTL.
+# Thời điểm lấy bằng TIME của Redis để đồng hồ lệch giữa các worker không xóa nhầm suất còn sống.
+_ACQUIRE_IP_SLOT_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local ttl = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if not redis.call('ZSCORE', KEYS[1], ARGV[3]) and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + ttl, ARGV[3])
+redis.call('PEXPIRE', KEYS[1], ttl)
+return 1
+"""
+
+def ip_slots_key(room_id: str, ip: str) -> str:
+    return f"ip_conn:{room_id}:{ip}"
 
-    if current_count >= max_connections:
-        # logging.warning(f"IP {ip} has reached max connections ({max_connections})")
-        return False
+async def acquire_ip_slot(room_id: str, ip: str, slot_id: str, max_connections: int) -> bool:
+    redis = get_redis()
+    with metrics.redis_seconds.time(op="ip_slot_acquire"):
+        ok = await redis.eval(_ACQUIRE_IP_SLOT_SCRIPT, 1, ip_slots_key(room_id, ip), IP_SLOT_TTL * 1000, max_connections, slot_id)
+    return ok == 1
 
-    await redis.lpush(key, username)
-    await redis.expire(key, 3600)
-    # logging.info(f"Added {username} to IP {ip}. Current users: {current_count + 1}")
-    return True
+# Gia hạn nhiều suất trong một lệnh, hạn mới cũng tính theo TIME của Redis
+_REFRESH_IP_SLOTS_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local ttl = tonumber(ARGV[1])
+for i = 1, #KEYS do
+    redis.call('ZADD', KEYS[i], 'XX', now + ttl, ARGV[i + 1])
+    redis.call('PEXPIRE', KEYS[i], ttl)
+end
+return #KEYS
+"""
 
-async def remove_user_from_ip(ip: str, username: str):
+async def refresh_ip_slots(slots: list):
+    # slots = [(room_id, ip, slot_id), ...]; gia hạn suất của các kết nối còn sống
+    if not slots:
+        return
     redis = get_redis()
-    key = f"ip_users:{ip}"
-    await redis.lrem(key, 1, username)
-    current_users = await redis.lrange(key, 0, -1)
-    if not current_users:
-        await redis.delete(key)
-    # Log để debug
-    import logging
-    # logging.info(f"Removed {username} from IP {ip}. Remaining users: {len(current_users)}")
-
-async def get_users_for_ip(ip: str) -> list:
+    keys = [ip_slots_key(room_id, ip) for room_id, ip, _ in slots]
+    with metrics.redis_seconds.time(op="ip_slot_refresh"):
+        await redis.eval(_REFRESH_IP_SLOTS_SCRIPT, len(keys), *keys, IP_SLOT_TTL * 1000, *[slot_id for _, _, slot_id in slots])
+
+async def release_ip_slot(room_id: str, ip: str, slot_id: str):
     redis = get_redis()
-    key = f"ip_users:{ip}"
-    return await redis.lrange(key, 0, -1)
+    with metrics.redis_seconds.time(op="ip_slot_release"):
+        await redis.zrem(ip_slots_key(room_id, ip), slot_id)
+
+# Danh sách user online của phòng, dùng chung cho mọi worker:
+# - hash "presence:{roomId}": username -> số worker đang giữ kết nối của user trong phòng
+# - sorted set "presence_workers:{roomId}": "{username}:{workerId}", score là thời điểm hết hạn (ms)
+# Worker chỉ ghi khi user có kết nối đầu tiên/đóng kết nối cuối cùng trong phòng trên worker đó, và gia hạn
+# các entry của mình ở mỗi nhịp heartbeat. Entry của worker chết hết hạn sau PRESENCE_TTL; script kế tiếp
+# chạm vào phòng sẽ dọn nó và trả về các user không còn worker nào giữ để báo "left".
+def room_users_key(room_id: str) -> str:
+    return f"presence:{room_id}"
+
+def room_workers_key(room_id: str) -> str:
+    return f"presence_workers:{room_id}"
+
+def _presence_member(username: str) -> str:
+    return f"{username}:{WORKER_ID}"
+
+_PRESENCE_PRUNE = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local ttl = tonumber(ARGV[1])
+local left = {}
+for _, member in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    redis.call('ZREM', KEYS[2], member)
+    local username = string.match(member, '^(.*):[^:]*$')
+    if redis.call('HINCRBY', KEYS[1], username, -1) <= 0 then
+        redis.call('HDEL', KEYS[1], username)
+        left[#left + 1] = username
+    end
+end
+local function enter(member, username)
+    if redis.call('ZADD', KEYS[2], now + ttl, member) == 1 then
+        return redis.call('HINCRBY', KEYS[1], username, 1)
+    end
+    return 0
+end
+local function touch()
+    redis.call('PEXPIRE', KEYS[1], ttl)
+    redis.call('PEXPIRE', KEYS[2], ttl)
+end
+"""
+
+# ARGV = ttl, member, username; trả về {số worker giữ user nếu entry mới được thêm (0 nếu đã có), users đã rời}
+_ENTER_ROOM_SCRIPT = _PRESENCE_PRUNE + """
+local n = enter(ARGV[2], ARGV[3])
+touch()
+return {n, left}
+"""
+
+# ARGV = ttl, member, username; trả về {số worker còn giữ user (-1 nếu entry đã bị dọn trước đó), users đã rời}
+_LEAVE_ROOM_SCRIPT = _PRESENCE_PRUNE + """
+local n = -1
+if redis.call('ZREM', KEYS[2], ARGV[2]) == 1 then
+    n = redis.call('HINCRBY', KEYS[1], ARGV[3], -1)
+    if n <= 0 then
+        redis.call('HDEL', KEYS[1], ARGV[3])
+    end
+end
+return {n, left}
+"""
+
+# ARGV = ttl, member1, username1, ...; gia hạn (hoặc thêm lại nếu đã bị dọn) entry của worker này,
+# trả về {users vừa thành online, users đã rời}
+_REFRESH_ROOM_SCRIPT = _PRESENCE_PRUNE + """
+local joined = {}
+for i = 2, #ARGV, 2 do
+    if enter(ARGV[i], ARGV[i + 1]) == 1 then
+        joined[#joined + 1] = ARGV[i + 1]
+    end
+end
+touch()
+return {joined, left}
+"""
+
+_presence_scripts = {}
+
+def _presence_script(source: str):
+    script = _presence_scripts.get(source)
+    if script is None:
+        script = _presence_scripts[source] = get_redis().register_script(source)
+    return script
+
+async def add_room_user(room_id: str, username: str) -> Tuple[bool, List[str]]:
+    # Trả về (user vừa online trên toàn cluster hay không, các user của worker chết vừa được dọn)
+    keys = [room_users_key(room_id), room_workers_key(room_id)]
+    with metrics.redis_seconds.time(op="presence_add"):
+        n, left = await _presence_script(_ENTER_ROOM_SCRIPT)(keys=keys, args=[PRESENCE_TTL * 1000, _presence_member(username), username])
+    return n == 1, left
+
+async def remove_room_user(room_id: str, username: str) -> Tuple[bool, List[str]]:
+    # Trả về (user đã rời hẳn khỏi cluster hay không, các user của worker chết vừa được dọn)
+    keys = [room_users_key(room_id), room_workers_key(room_id)]
+    with metrics.redis_seconds.time(op="presence_remove"):
+        n, left = await _presence_script(_LEAVE_ROOM_SCRIPT)(keys=keys, args=[PRESENCE_TTL * 1000, _presence_member(username), username])
+    return n == 0, left
+
+async def refresh_room_users(rooms: Dict[str, List[str]]) -> Dict[str, Tuple[List[str], List[str]]]:
+    # rooms = {roomId: [username có kết nối trên worker này]}; trả về {roomId: (joined, left)} cho các phòng có thay đổi
+    if not rooms:
+        return {}
+    script = _presence_script(_REFRESH_ROOM_SCRIPT)
+    with metrics.redis_seconds.time(op="presence_refresh"):
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for room_id, usernames in rooms.items():
+                args = [PRESENCE_TTL * 1000]
+                for username in usernames:
+                    args += [_presence_member(username), username]
+                await script(keys=[room_users_key(room_id), room_workers_key(room_id)], args=args, client=pipe)
+            results = await pipe.execute()
+    return {room_id: (joined, left) for room_id, (joined, left) in zip(rooms, results) if joined or left}
 
-async def set_session(username: str, session_id: str):
+async def get_room_users(room_id: str) -> list:
     redis = get_redis()
-    key = f"session:{username}"
-    await redis.set(key, session_id, ex=3600)  # TTL 1 giờ
\ No newline at end of file
+    with metrics.redis_seconds.time(op="presence_list"):
+        return await redis.hkeys(room_users_key(room_id))
@@ -0,0 +1,90 @@
+# ./registry.py
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Tuple
+from fastapi import WebSocket
+from sender import ConnectionSender
+
+# (roomId, connectionId, username). connectionId sinh mới cho mỗi lần kết nối: nhiều tab dùng chung
+# username (và cùng sessionId, vì /session/ trả lại token đã cấp) vẫn là các kết nối riêng
+ConnectionKey = Tuple[str, str, str]
+
+
+class Connection:
+    # __slots__ để mỗi kết nối chỉ tốn vài chục byte ngoài WebSocket và hàng đợi gửi
+    __slots__ = ("room_id", "connection_id", "session_id", "username", "client_ip", "websocket", "sender", "ip_slot", "last_seen", "alive")
+
+    def __init__(self, room_id: str, session_id: str, username: str, client_ip: str, websocket: WebSocket,
+                 ip_slot: Optional[str] = None):
+        self.room_id = room_id
+        self.connection_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.username = username
+        self.client_ip = client_ip
+        self.websocket = websocket
+        self.sender: Optional[ConnectionSender] = None
+        self.ip_slot = ip_slot  # id suất kết nối IP trong Redis (chỉ có với phòng riêng)
+        self.last_seen = time.monotonic()  # lần cuối nhận được frame (kể cả pong) từ client
+        self.alive = True  # False sau khi disconnect đã dọn dẹp, tránh dọn hai lần
+
+    @property
+    def key(self) -> ConnectionKey:
+        return self.room_id, self.connection_id, self.username
+
+
+class ConnectionRegistry:
+    """Danh bạ kết nối của worker, tra cứu O(1) theo phòng, theo user trong phòng và theo kết nối.
+
+    Danh sách thành viên mỗi phòng được cập nhật dần khi thêm/xóa kết nối, không phải quét lại cả phòng.
+    """
+
+    def __init__(self):
+        self.connections: Dict[ConnectionKey, Connection] = {}
+        self.rooms: Dict[str, Dict[ConnectionKey, Connection]] = {}  # roomId -> {key: Connection}
+        self.members: Dict[str, Dict[str, Dict[ConnectionKey, Connection]]] = {}  # roomId -> {username -> {key: Connection}}
+
+    def add(self, connection: Connection) -> Optional[Connection]:
+        # Trả về kết nối cũ cùng key (nếu có) đã bị thay thế
+        previous = self.remove(self.connections.get(connection.key))
+        key = connection.key
+        self.connections[key] = connection
+        self.rooms.setdefault(connection.room_id, {})[key] = connection
+        self.members.setdefault(connection.room_id, {}).setdefault(connection.username, {})[key] = connection
+        return previous
+
+    def remove(self, connection: Optional[Connection]) -> Optional[Connection]:
+        # Chỉ xóa đúng đối tượng đã đăng ký, tránh gỡ nhầm kết nối mới cùng key
+        if connection is None or self.connections.get(connection.key) is not connection:
+            return None
+        key = connection.key
+        del self.connections[key]
+        room = self.rooms[connection.room_id]
+        del room[key]
+        if not room:
+            del self.rooms[connection.room_id]
+        members = self.members[connection.room_id]
+        user_connections = members[connection.username]
+        del user_connections[key]
+        if not user_connections:
+            del members[connection.username]
+        if not members:
+            del self.members[connection.room_id]
+        return connection
+
+    def all(self) -> Iterable[Connection]:
+        return self.connections.values()
+
+    def room_ids(self) -> Iterable[str]:
+        return self.rooms.keys()
+
+    def in_room(self, room_id: str) -> Iterable[Connection]:
+        return self.rooms.get(room_id, {}).values()
+
+    def of_user(self, room_id: str, username: str) -> Iterable[Connection]:
+        return self.members.get(room_id, {}).get(username, {}).values()
+
+    def has_room(self, room_id: str) -> bool:
+        return room_id in self.rooms
+
+    def __len__(self) -> int:
+        return len(self.connections)
@@ -1,17 +1,36 @@
 # ./routers/chat_api.py
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from typing import Optional
 from redis_client import get_redis
-from config import REDIS_CHANNEL
+from config import HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE, ROOMS_CACHE_TTL
+from history import read_history, next_message_id
+from persistence import persistence
+from ratelimit import rate_limiter
+from sharding import shards
+from public_keys import fetch_keys
 import json
 from datetime import datetime
 from manager import manager
 from models.schemas import SendMessageRequest
+from serialization import Frame, dumps
+from cache import TTLCache
+from pubsub import broker
+import metrics
+import hashlib
 import re
-from utils.jwt_utils import create_jwt, decode_jwt
+from sessions import sessions
 from pydantic import BaseModel
 
 api_router = APIRouter()
 
+# Danh sách phòng đã serialize sẵn kèm ETag; bị xóa khi có phòng mới hoặc đổi cấu hình trên bất kỳ worker nào
+rooms_cache = TTLCache(maxsize=1, ttl=ROOMS_CACHE_TTL)
+broker.on_control("rooms", lambda payload: rooms_cache.clear())
+
+async def invalidate_rooms():
+    rooms_cache.clear()
+    await broker.publish_control("rooms")
+
 class SetRoomOptionsRequest(BaseModel):
     room_id: int
     room_type: str
@@ -27,8 +46,12 @@ class RoomInfo(BaseModel):
     password: str = None  # Thêm trường password
 
 @api_router.post("/send/")
-async def send_message(req: SendMessageRequest):
-    redis_client = get_redis()
+async def send_message(req: SendMessageRequest, request: Request):
+    client_ip = request.headers.get("X-Forwarded-For") or (request.client.host if request.client else req.username)
+    retry = await rate_limiter.acquire(req.username, client_ip, str(req.roomId))
+    if retry:
+        metrics.rate_limited.inc(path="http")
+        raise HTTPException(status_code=429, detail="Too many messages.", headers={"Retry-After": str(max(1, round(retry)))})
     try:
         content_dict = req.content.dict(exclude_unset=True)  # Chuyển content thành dict
         # Input validation: loại bỏ script tag trong text
@@ -38,32 +61,40 @@ async def send_message(req: SendMessageRequest):
         if req.type == "sticker" and "sticker_id" not in content_dict:
             content_dict["sticker_id"] = req.content.text or req.content.emoji or "unknown"  # Dùng text/emoji làm fallback
         msg = {
+            "id": next_message_id(),
             "type": req.type,
             "username": req.username,
             "content": content_dict,
             "timestamp": datetime.utcnow().isoformat()
         }
-        room_channel = f"{REDIS_CHANNEL}:{req.roomId}"
-        await redis_client.rpush(room_channel, json.dumps(msg))
-        await manager.broadcast(msg, str(req.roomId))
+        frame = Frame(msg)  # Encode một lần, dùng cho cả Redis và mọi socket
+        # API trả về success nghĩa là tin đã được lưu, nên luôn chờ Redis xác nhận
+        entry_id = await persistence.append(str(req.roomId), msg["id"], frame.text, durable=True)
+        if entry_id != msg["id"]:
+            frame = Frame({**msg, "id": entry_id})  # broadcast với id thật của entry trong Redis
+        await manager.broadcast(frame, str(req.roomId))
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/messages/{room_id}/")
-async def get_messages(room_id: str):
-    redis_client = get_redis()
+async def get_messages(
+    room_id: str,
+    before: Optional[str] = Query(None, pattern=r"^\d+(-\d+)?$"),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+):
+    # Phân trang theo cursor: trả về `limit` tin trước id `before` (mặc định là các tin mới nhất)
     try:
-        room_channel = f"{REDIS_CHANNEL}:{room_id}"
-        messages_raw = await redis_client.lrange(room_channel, 0, -1)
-        return [json.loads(m) for m in messages_raw]
+        body = dumps(await read_history(room_id, limit, before))
+        metrics.history_bytes.observe(len(body), kind="page")
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.get("/session/{username}")
 async def get_session_id(username: str):
-    # Không dùng sessionId truyền thống nữa, trả về JWT
-    token = create_jwt(username)
+    # Không dùng sessionId truyền thống nữa, trả về JWT (dùng lại token vừa cấp cho cùng username)
+    token = sessions.issue(username)
     return {"sessionId": token}
 
 @api_router.post("/create_room")
@@ -71,6 +102,7 @@ async def create_room(room: RoomInfo):
     redis = get_redis()
     # Lưu phòng vào Redis (dùng hash hoặc list)
     await redis.hset("rooms", str(room.id), room.json())  # Đảm bảo key là str
+    await invalidate_rooms()
     return {"status": "success", "room": room.dict()}
 
 @api_router.post("/set_room_options")
@@ -84,17 +116,34 @@ async def set_room_options(req: SetRoomOptionsRequest):
         if req.options and "max_connections_per_ip" in req.options:
             room["max_connections_per_ip"] = req.options["max_connections_per_ip"]
         await redis.hset("rooms", str(req.room_id), json.dumps(room))
+        await invalidate_rooms()
     return {"status": "success", "room_id": req.room_id, "room_type": req.room_type, "options": req.options}
 
+@api_router.get("/rooms/{room_id}/owner")
+async def get_room_owner(room_id: str):
+    # Node phục vụ WebSocket của phòng (khi bật chia phòng); client nối thẳng vào đó để khỏi bị chuyển hướng
+    return {"roomId": room_id, "node": shards.owner_of(room_id), "sharding": shards.enabled}
+
+@api_router.get("/rooms/{room_id}/keys")
+async def get_room_keys(room_id: str, since: int = Query(0, ge=0)):
+    # Danh bạ publicKey của phòng: since=0 trả về toàn bộ, since=<version> chỉ trả các key đổi/bị xóa sau đó
+    return await fetch_keys(room_id, since)
+
 @api_router.get("/rooms")
-async def get_rooms():
-    redis = get_redis()
-    rooms = await redis.hgetall("rooms")
-    # Trả về danh sách phòng (giá trị là bytes hoặc str, cần xử lý an toàn)
-    result = []
-    for v in rooms.values():
-        if isinstance(v, bytes):
-            result.append(json.loads(v.decode()))
-        else:
-            result.append(json.loads(v))
-    return result
\ No newline at end of file
+async def get_rooms(request: Request):
+    cached = rooms_cache.get("rooms")
+    if cached is None:
+        redis = get_redis()
+        with metrics.redis_seconds.time(op="rooms_list"):
+            rooms = await redis.hgetall("rooms")
+        # Mỗi giá trị đã là JSON của một phòng, ghép thẳng thành mảng JSON mà không cần decode
+        # (giá trị là bytes hoặc str, cần xử lý an toàn)
+        body = "[" + ",".join(v.decode() if isinstance(v, bytes) else v for v in rooms.values()) + "]"
+        body = body.encode()
+        cached = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+        rooms_cache.set("rooms", cached)
+    body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
\ No newline at end of file
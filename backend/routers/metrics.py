@@ -0,0 +1,17 @@
+# ./routers/metrics.py
+from fastapi import APIRouter, Query
+from fastapi.responses import PlainTextResponse
+from typing import Optional
+import metrics
+
+metrics_router = APIRouter()
+
+@metrics_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # Định dạng text của Prometheus; mỗi worker trả về số liệu của riêng nó
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@metrics_router.get("/metrics/profile", response_class=PlainTextResponse)
+async def get_profile(section: Optional[str] = Query(None), limit: int = Query(30, ge=1, le=200)):
+    # Kết quả cProfile cộng dồn của broadcast/vòng nhận tin, chỉ có khi bật PROFILE_SAMPLE_RATE
+    return PlainTextResponse(metrics.profile_report(section, limit))
@@ -1,14 +1,62 @@
 # ./routers/websocket.py
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-import json
-from redis_client import get_redis
-from config import REDIS_CHANNEL
+from typing import Optional, Tuple
+from config import HISTORY_JOIN_SIZE, HISTORY_PAGE_SIZE, PERSIST_DURABLE, RATE_LIMIT_POLICY, RATE_MAX_DELAY
+from history import read_history, read_since, has_gap, next_message_id
+from persistence import persistence
+from ratelimit import rate_limiter, control_limiter
+from sharding import shards
+from public_keys import store_key, fetch_keys
+import asyncio
+import re
+import time
 from manager import manager
 from datetime import datetime
-from utils.jwt_utils import decode_jwt
+from serialization import Frame, loads, unpackb, msgpack
+import metrics
 
 websocket_router = APIRouter()
 
+# Giao thức client chọn qua subprotocol (Sec-WebSocket-Protocol) hoặc query "protocol"; mặc định là JSON
+PROTOCOLS = ("msgpack", "json")
+
+def negotiate_protocol(websocket: WebSocket) -> Tuple[bool, Optional[str]]:
+    # Trả về (dùng MessagePack hay không, subprotocol cần trả lời khi accept)
+    offered = [p.strip() for p in websocket.headers.get("sec-websocket-protocol", "").split(",") if p.strip()]
+    for protocol in offered:
+        if protocol in PROTOCOLS and (protocol != "msgpack" or msgpack is not None):
+            return protocol == "msgpack", protocol
+    requested = websocket.query_params.get("protocol", "json")
+    return requested == "msgpack" and msgpack is not None, None
+
+# Các loại frame tốn một lượt gọi Redis hoặc một lượt broadcast cả phòng; mỗi frame tính một token.
+# Tin nhắn mã hóa là một frame duy nhất chứa bản mã của mọi người nhận; frame điều khiển dùng bucket riêng
+MESSAGE_TYPES = {"message", "sticker"}
+CONTROL_TYPES = {"publicKey", "getKeys", "users"}
+RATE_LIMITED_TYPES = MESSAGE_TYPES | CONTROL_TYPES
+
+async def allow_message(connection, room_id: str, message: dict) -> bool:
+    limiter = rate_limiter if message.get("type") in MESSAGE_TYPES else control_limiter
+    retry = await limiter.acquire(connection.username, connection.client_ip, room_id)
+    if retry and RATE_LIMIT_POLICY == "delay" and retry <= RATE_MAX_DELAY:
+        # Chỉ làm chậm vòng nhận của kết nối này, các kết nối khác không bị ảnh hưởng
+        await asyncio.sleep(retry)
+        retry = await limiter.acquire(connection.username, connection.client_ip, room_id)
+    if retry:
+        metrics.rate_limited.inc(path="ws")
+        manager.send_personal(connection, {"type": "error", "code": "rate_limited", "retryAfter": round(retry, 3)})
+        return False
+    return True
+
+async def receive_message(websocket: WebSocket) -> dict:
+    # Client có thể gửi frame text (JSON) hoặc binary (MessagePack), không phụ thuộc giao thức nhận
+    data = await websocket.receive()
+    if data["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(data.get("code", 1000))
+    if data.get("bytes") is not None:
+        return unpackb(data["bytes"])
+    return loads(data["text"])
+
 @websocket_router.websocket("/ws/chat/{username}")
 async def chat_ws(websocket: WebSocket, username: str):
     # Lấy IP thật nếu có, nếu không thì dùng username làm IP (dev mode)
@@ -17,69 +65,113 @@ async def chat_ws(websocket: WebSocket, username: str):
         client_ip = username
     session_id = websocket.query_params.get("sessionId", "")
     room_id = websocket.query_params.get("roomId", "1")  # Lấy roomId từ query params, mặc định là "1"
-    # Xác thực JWT thay vì sessionId truyền thống
-    jwt_data = decode_jwt(session_id)
-    if not jwt_data or jwt_data.get("sub") != username:
-        await websocket.close(code=1008, reason="Invalid session ID")
+    # Id của tin nhắn cuối client đã nhận trước khi mất kết nối, nếu có thì chỉ gửi bù phần còn thiếu
+    last_seen_id = websocket.query_params.get("lastSeenId", "")
+    if not re.fullmatch(r"\d+-\d+", last_seen_id):
+        last_seen_id = ""
+    # sessionId là JWT, được manager.connect xác thực (có cache) trước khi nhận kết nối
+    binary, subprotocol = negotiate_protocol(websocket)
+    # Chế độ chia phòng theo node: phòng thuộc node khác thì báo địa chỉ node chủ rồi đóng
+    owner = shards.redirect_for(room_id)
+    if owner is not None:
+        await websocket.accept(subprotocol=subprotocol)
+        frame = Frame({"type": "redirect", "url": owner, "roomId": room_id})
+        if binary:
+            await websocket.send_bytes(frame.binary)
+        else:
+            await websocket.send_text(frame.text)
+        await websocket.close(code=4001, reason="Room moved.")
         return
-
-    # Đảm bảo sessionId có trong manager.sessions để các hàm connect/disconnect không bị lỗi
-    if username not in manager.sessions:
-        manager.sessions[username] = {}
-    if session_id not in manager.sessions[username]:
-        manager.sessions[username][session_id] = username
-
-    if not await manager.connect(websocket, username, client_ip, room_id):
+    connection = await manager.connect(websocket, username, client_ip, room_id, binary, subprotocol)
+    if connection is None:
         return
 
-    redis_client = get_redis()
-
     try:
         # Gửi sessionId khi kết nối thành công
-        await websocket.send_json({"type": "session", "sessionId": session_id})
+        manager.send_personal(connection, {"type": "session", "sessionId": session_id,
+                                           "protocol": "msgpack" if binary else "json"})
 
-        # Lấy danh sách người dùng online trong phòng
-        active_users = set()
-        for session_users in manager.active_connections.get(room_id, {}).values():
-            active_users.update(session_users.keys())
-        await websocket.send_json({"type": "users", "users": list(active_users)})
+        # Gửi danh sách người dùng online trong phòng (trên toàn cluster)
+        await manager.send_users(connection)
 
-        # Gửi lịch sử tin nhắn
-        room_channel = f"{REDIS_CHANNEL}:{room_id}"
-        messages_raw = await redis_client.lrange(room_channel, 0, -1)
-        messages = [json.loads(m) for m in messages_raw if json.loads(m).get("type") in ["message", "sticker"]]
-        await websocket.send_json({"type": "history", "messages": messages})
+        if last_seen_id and not await has_gap(room_id, last_seen_id):
+            # Kết nối lại: chỉ gửi các tin mới hơn lastSeenId, chia thành nhiều frame "replay"
+            more = True
+            while more:
+                messages, more = await read_since(room_id, last_seen_id, HISTORY_PAGE_SIZE)
+                if not messages:
+                    break
+                last_seen_id = messages[-1]["id"]
+                messages = [m for m in messages if m.get("type") in ["message", "sticker"]]
+                frame = Frame({"type": "replay", "messages": messages})
+                metrics.history_bytes.observe(len(frame.encoded(binary)), kind="replay")
+                manager.send_personal(connection, frame)
+        else:
+            # Gửi lịch sử tin nhắn: chỉ HISTORY_JOIN_SIZE tin gần nhất, client tự tải thêm qua /messages
+            messages = [m for m in await read_history(room_id, HISTORY_JOIN_SIZE) if m.get("type") in ["message", "sticker"]]
+            frame = Frame({"type": "history", "messages": messages})
+            metrics.history_bytes.observe(len(frame.encoded(binary)), kind="history")
+            manager.send_personal(connection, frame)
 
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-
+            message = await receive_message(websocket)
+            connection.last_seen = time.monotonic()
+            if message.get("type") in RATE_LIMITED_TYPES and not await allow_message(connection, message.get("roomId", room_id), message):
+                continue
             if message.get("type") in ["message", "sticker"]:
                 room_id = message.get("roomId", room_id)
-                msg = {
-                    "type": message["type"],
-                    "username": username,
-                    "content": message["content"],
-                    "roomId": room_id,
-                    "timestamp": message.get("timestamp", datetime.utcnow().isoformat())
-                }
-                room_channel = f"{REDIS_CHANNEL}:{room_id}"
-                await redis_client.rpush(room_channel, json.dumps(msg))
-                await manager.broadcast(msg, room_id)
+                # Khi bật PROFILE_SAMPLE_RATE, một phần nhỏ các lượt dựng và encode frame được đo bằng cProfile.
+                # Chỉ đo đoạn không await: profiler bật qua await sẽ ghi cả các task khác trên event loop
+                with metrics.profiled("receive"):
+                    msg = {
+                        "id": next_message_id(),
+                        "type": message["type"],
+                        "username": username,
+                        "content": message["content"],
+                        "roomId": room_id,
+                        "timestamp": message.get("timestamp", datetime.utcnow().isoformat())
+                    }
+                    frame = Frame(msg)  # Encode một lần, dùng cho cả Redis và mọi socket
+                    frame.text  # encode JSON ngay trong đoạn được đo
+                if PERSIST_DURABLE:
+                    # Chờ Redis ghi xong rồi broadcast với id thật của entry (khác id tạm nếu Redis phải tự cấp)
+                    entry_id = await persistence.append(room_id, msg["id"], frame.text, durable=True)
+                    if entry_id != msg["id"]:
+                        frame = Frame({**msg, "id": entry_id})
+                    await manager.broadcast(frame, room_id)
+                else:
+                    # Broadcast ngay, việc ghi Redis được gom lô ở nền; nếu Redis cấp id khác,
+                    # persistence báo lại qua manager.remap_ids
+                    await manager.broadcast(frame, room_id)
+                    await persistence.append(room_id, msg["id"], frame.text)
             elif message.get("type") == "publicKey":
                 room_id = message.get("roomId", room_id)
-                public_key_msg = {
-                    "type": "publicKey",
-                    "username": username,
-                    "publicKey": message["publicKey"],
-                    "roomId": room_id
-                }
-                manager.store_public_key(username, message["publicKey"])  # Lưu trữ publicKey
-                await manager.broadcast(public_key_msg, room_id)
+                # Lưu vào danh bạ của phòng; chỉ báo cho cả phòng khi key thực sự thay đổi
+                version, changed = await store_key(room_id, username, message["publicKey"])
+                if changed:
+                    public_key_msg = {
+                        "type": "publicKey",
+                        "username": username,
+                        "publicKey": message["publicKey"],
+                        "roomId": room_id,
+                        "version": version
+                    }
+                    await manager.broadcast(public_key_msg, room_id)
+            elif message.get("type") == "getKeys":
+                # Client lấy một lần toàn bộ key của phòng, hoặc chỉ các key đổi sau version đã có
+                since = message.get("since")
+                since = since if isinstance(since, int) and since > 0 else 0
+                keys = await fetch_keys(message.get("roomId", room_id), since)
+                manager.send_personal(connection, {"type": "keys", **keys})
+            elif message.get("type") == "pong":
+                pass  # chỉ cần cập nhật last_seen ở trên
+            elif message.get("type") == "users":
+                # Client yêu cầu lại danh sách online đầy đủ
+                await manager.send_users(connection)
             else:
                 pass  # print(f"Ignored message with type: {message.get('type')}")
 
     except WebSocketDisconnect as e:
-        await manager.disconnect(websocket, username, client_ip, room_id)
+        await manager.disconnect(connection)
     except Exception as e:
-        await manager.disconnect(websocket, username, client_ip, room_id)
\ No newline at end of file
+        await manager.disconnect(connection)
\ No newline at end of file
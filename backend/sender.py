@@ -0,0 +1,125 @@
+# ./sender.py
+import asyncio
+import logging
+from collections import deque
+from fastapi import WebSocket
+from config import SEND_QUEUE_SIZE, SLOW_CONSUMER_POLICY
+from serialization import Frame
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Các loại tin nhắn mà bản mới thay thế hoàn toàn bản cũ (chỉ cần giữ bản cuối)
+COALESCE_TYPES = {"users"}
+# Các loại tin nhắn có thể bỏ khi hàng đợi đầy mà client không mất gì cần nhận bù. Tin chat và presence
+# (danh sách thay đổi, bỏ một bản là lệch danh sách online) thì không: phải ngắt để client kết nối lại
+DROPPABLE_TYPES = {"notification"}
+
+
+class ConnectionSender:
+    """Hàng đợi gửi có giới hạn kèm một task ghi riêng cho mỗi WebSocket.
+
+    send() không bao giờ await, nên vòng broadcast không bị một client chậm
+    giữ lại. Khi hàng đợi đầy, client chậm bị ngắt ("drop") hoặc thông báo cũ
+    bị bỏ bớt ("coalesce"); không bao giờ âm thầm bỏ tin chat.
+    """
+
+    __slots__ = ("websocket", "binary", "maxsize", "policy", "queue", "ready", "closed", "closing", "task")
+
+    def __init__(self, websocket: WebSocket, binary: bool = False, maxsize: int = SEND_QUEUE_SIZE,
+                 policy: str = SLOW_CONSUMER_POLICY):
+        self.websocket = websocket
+        self.binary = binary  # True: gửi frame MessagePack thay vì JSON
+        self.maxsize = maxsize
+        self.policy = policy
+        self.queue: deque = deque()
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.closing = None  # (code, reason) khi socket sẽ được đóng sau khi gửi hết hàng đợi
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, frame: Frame) -> bool:
+        if self.closed or self.closing is not None:
+            return False
+        if len(self.queue) >= self.maxsize and not self._make_room(frame):
+            if self.policy == "coalesce" and frame.message.get("type") in DROPPABLE_TYPES:
+                metrics.send_dropped.inc()  # hàng đợi toàn tin quan trọng: bỏ chính thông báo mới
+                return False
+            metrics.slow_consumers.inc()
+            metrics.send_dropped.inc(len(self.queue) + 1)
+            self.abort(reason="Client too slow.")
+            return False
+        self.queue.append(frame)
+        metrics.send_queue_depth.inc()
+        if len(self.queue) > metrics.send_queue_max_depth.get():
+            metrics.send_queue_max_depth.set(len(self.queue))
+        self.ready.set()
+        return True
+
+    def _make_room(self, frame: Frame) -> bool:
+        # Chỉ với "coalesce": bỏ bản cũ của tin cùng loại có thể gộp, hoặc thông báo cũ nhất.
+        # False nếu không có gì bỏ được
+        if self.policy != "coalesce":
+            return False
+        frame_type = frame.message.get("type")
+        for pending in self.queue:
+            pending_type = pending.message.get("type")
+            if pending_type in DROPPABLE_TYPES or (pending_type == frame_type and frame_type in COALESCE_TYPES):
+                self.queue.remove(pending)
+                metrics.send_queue_depth.dec()
+                metrics.send_dropped.inc()
+                return True
+        return False
+
+    async def _run(self):
+        try:
+            while True:
+                if not self.queue:
+                    if self.closing is not None:
+                        await self._close_socket(*self.closing)
+                        return
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                frame = self.queue.popleft()
+                metrics.send_queue_depth.dec()
+                if self.binary:
+                    await self.websocket.send_bytes(frame.binary)
+                else:
+                    await self.websocket.send_text(frame.text)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # logger.error(f"Send failed: {e}")
+            metrics.send_failures.inc()
+            self.abort()
+
+    def finish(self, frame: Frame, code: int = 1000, reason: str = ""):
+        # Gửi nốt các tin đang chờ và frame cuối cùng rồi đóng socket (ví dụ chuyển client sang node khác)
+        if self.closed or self.closing is not None:
+            return
+        self.send(frame)
+        self.closing = (code, reason)
+        self.ready.set()
+
+    def abort(self, reason: str = ""):
+        # Dừng task ghi và đóng socket; vòng nhận trong chat_ws sẽ gọi disconnect để dọn dẹp
+        if self.closed:
+            return
+        self.close()
+        asyncio.create_task(self._close_socket(1008, reason))
+
+    async def _close_socket(self, code: int, reason: str):
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        metrics.send_queue_depth.dec(len(self.queue))
+        self.queue.clear()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
@@ -0,0 +1,64 @@
+# ./serialization.py
+import json
+
+# orjson nhanh hơn json chuẩn nhiều lần; dùng nếu đã cài, không thì quay về json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# MessagePack cho client chọn giao thức nhị phân; không cài thì mọi kết nối dùng JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False)
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def packb(obj) -> bytes:
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpackb(data: bytes):
+    return msgpack.unpackb(data, raw=False)
+
+
+class Frame:
+    """Tin nhắn kèm bản JSON (và MessagePack nếu cần) đã mã hóa, mỗi dạng chỉ encode một lần cho mọi socket."""
+
+    __slots__ = ("message", "_text", "_binary")
+
+    def __init__(self, message: dict, text: str = None):
+        self.message = message
+        self._text = text
+        self._binary = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = dumps(self.message)
+        return self._text
+
+    @property
+    def binary(self) -> bytes:
+        if self._binary is None:
+            self._binary = packb(self.message)
+        return self._binary
+
+    def encoded(self, binary: bool):
+        return self.binary if binary else self.text
+
+    @classmethod
+    def of(cls, message) -> "Frame":
+        return message if isinstance(message, cls) else cls(message)
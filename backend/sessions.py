@@ -0,0 +1,51 @@
+# ./sessions.py
+import time
+from typing import Optional
+from cache import TTLCache
+from config import SESSION_CACHE_SIZE, SESSION_VERIFY_TTL, SESSION_REUSE_WINDOW
+from utils.jwt_utils import JWT_TTL, create_jwt, decode_jwt
+import metrics
+
+
+class SessionStore:
+    """Token phiên (JWT) đã cấp và đã xác thực trên worker này.
+
+    Cả hai cache đều giới hạn kích thước và tự hết hạn, nên số phiên giữ trong bộ nhớ không
+    tăng mãi. Token đã xác thực chỉ được tin đến trước `exp` của chính nó.
+    """
+
+    def __init__(self, maxsize: int = SESSION_CACHE_SIZE, verify_ttl: float = SESSION_VERIFY_TTL,
+                 reuse_window: float = SESSION_REUSE_WINDOW):
+        self.verified = TTLCache(maxsize, verify_ttl)  # token -> username
+        self.issued = TTLCache(maxsize, reuse_window)  # username -> token
+
+    def issue(self, username: str) -> str:
+        token = self.issued.get(username)
+        if token is None:
+            expires_at = time.time() + JWT_TTL.total_seconds()
+            token = create_jwt(username)
+            self.issued.set(username, token)
+            # Token do chính server ký, không cần verify lại khi client kết nối vào worker này
+            self.verified.set(token, username, ttl=min(expires_at - time.time(), self.verified.ttl))
+        return token
+
+    def verify(self, token: str) -> Optional[str]:
+        """Trả về username của token hợp lệ, None nếu token sai hoặc đã hết hạn."""
+        if not token:
+            return None
+        username = self.verified.get(token)
+        if username is not None:
+            metrics.session_cache_hits.inc()
+            return username
+        with metrics.jwt_seconds.time():
+            claims = decode_jwt(token)
+        if not claims or not claims.get("sub"):
+            return None
+        remaining = claims.get("exp", 0) - time.time()
+        if remaining <= 0:
+            return None
+        self.verified.set(token, claims["sub"], ttl=min(remaining, self.verified.ttl))
+        return claims["sub"]
+
+
+sessions = SessionStore()
@@ -0,0 +1,138 @@
+# ./sharding.py
+import asyncio
+import hashlib
+import logging
+from bisect import bisect
+from typing import List, Optional
+from redis_client import get_redis
+from pubsub import broker
+from serialization import Frame
+from manager import manager
+from config import SHARDING_ENABLED, NODE_URL, NODE_HEARTBEAT, NODE_TTL, HASH_VNODES, HANDOFF_BATCH
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Danh sách node đang sống: sorted set "nodes", member là NODE_URL, score là lần gia hạn cuối (ms).
+# Các worker của cùng một node dùng chung NODE_URL nên được tính là một node.
+NODES_KEY = "nodes"
+
+# Gia hạn node này, loại các node quá ARGV[2] ms không gia hạn và trả về danh sách còn lại. Dùng đồng hồ
+# của Redis: một node chạy nhanh giờ hơn NODE_TTL không được loại nhầm mọi node khác
+_REFRESH_NODES_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]))
+return redis.call('ZRANGE', KEYS[1], 0, -1)
+"""
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Vòng consistent hashing: thêm/bớt một node chỉ làm khoảng 1/N số phòng đổi chủ."""
+
+    def __init__(self, nodes: List[str], vnodes: int = HASH_VNODES):
+        self.nodes = sorted(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, room_id: str) -> Optional[str]:
+        if not self.owners:
+            return None
+        return self.owners[bisect(self.hashes, _hash(str(room_id))) % len(self.owners)]
+
+
+class ShardCoordinator:
+    """Giữ tư cách thành viên của node trong Redis, tính chủ của mỗi phòng và chuyển kết nối khi vòng hash đổi."""
+
+    def __init__(self, manager, node_url: str = NODE_URL, enabled: bool = SHARDING_ENABLED):
+        self.manager = manager
+        self.node_url = node_url
+        self.enabled = enabled
+        self.ring = HashRing([node_url])
+        self.task: Optional[asyncio.Task] = None
+        self.refresh_script = None
+        # Node khác vào/ra thì cập nhật ngay, không chờ đến nhịp heartbeat sau
+        broker.on_control("nodes", lambda payload: self._schedule_refresh())
+
+    async def start(self):
+        if not self.enabled:
+            return
+        await self.refresh()
+        self.task = asyncio.create_task(self._run())
+        await broker.publish_control("nodes", {"joined": self.node_url})
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.enabled:
+            # Rời vòng hash ngay để các node khác nhận lại phòng, không phải chờ NODE_TTL. Không cần handoff:
+            # uvicorn đã đóng mọi WebSocket (mã 1012) trước khi chạy shutdown, client kết nối lại qua địa chỉ
+            # mặc định và được chuyển hướng tới node chủ mới
+            await get_redis().zrem(NODES_KEY, self.node_url)
+            await broker.publish_control("nodes", {"left": self.node_url})
+
+    def owner_of(self, room_id: str) -> str:
+        return self.ring.owner(room_id) or self.node_url
+
+    def redirect_for(self, room_id: str) -> Optional[str]:
+        # URL của node chủ nếu phòng không thuộc node này, None nếu phục vụ tại đây
+        if not self.enabled:
+            return None
+        owner = self.owner_of(room_id)
+        return None if owner == self.node_url else owner
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(NODE_HEARTBEAT)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Shard refresh failed: {e}")
+
+    def _schedule_refresh(self):
+        if self.enabled:
+            asyncio.create_task(self.refresh())
+
+    async def refresh(self):
+        if self.refresh_script is None:
+            self.refresh_script = get_redis().register_script(_REFRESH_NODES_SCRIPT)
+        nodes = await self.refresh_script(keys=[NODES_KEY], args=[self.node_url, int(NODE_TTL * 1000)])
+        if sorted(nodes) != self.ring.nodes:
+            logger.info(f"Hash ring changed: {nodes}")
+            self.ring = HashRing(nodes)
+            metrics.ring_nodes.set(len(nodes))
+        await self.handoff()
+
+    async def handoff(self):
+        # Chuyển các kết nối của phòng không còn thuộc node này sang node chủ mới, mỗi lượt tối đa HANDOFF_BATCH;
+        # client kết nối lại kèm lastSeenId nên không mất tin nhắn
+        moved = 0
+        for room_id in list(self.manager.registry.room_ids()):
+            owner = self.redirect_for(room_id)
+            if owner is None:
+                continue
+            frame = Frame({"type": "redirect", "url": owner, "roomId": room_id})
+            for connection in list(self.manager.registry.in_room(room_id)):
+                if connection.sender.closing is not None:
+                    continue
+                connection.sender.finish(frame, code=4001, reason="Room moved.")
+                moved += 1
+                if moved >= HANDOFF_BATCH:
+                    metrics.handoffs.inc(moved)
+                    return
+        if moved:
+            metrics.handoffs.inc(moved)
+
+
+shards = ShardCoordinator(manager)
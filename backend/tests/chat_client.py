@@ -0,0 +1,45 @@
+# ./tests/chat_client.py
+# Client WebSocket tối giản cho test nhiều process
+import asyncio
+import json
+import urllib.request
+from datetime import datetime
+import websockets
+
+
+def session_token(worker, username: str) -> str:
+    with urllib.request.urlopen(f"{worker.http}/session/{username}", timeout=5) as response:
+        return json.load(response)["sessionId"]
+
+
+def get_json(url: str):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+async def connect(worker, username: str, room_id: str):
+    token = session_token(worker, username)
+    return await websockets.connect(f"{worker.ws}/ws/chat/{username}?sessionId={token}&roomId={room_id}")
+
+
+async def send(ws, frame: dict):
+    await ws.send(json.dumps(frame))
+
+
+async def send_text(ws, room_id: str, text: str, timestamp: str = None):
+    await send(ws, {"type": "message", "content": {"text": text}, "roomId": room_id,
+                    "timestamp": timestamp or datetime.utcnow().isoformat()})
+
+
+async def wait_for(ws, predicate, timeout: float = 5.0) -> dict:
+    """Đọc frame cho đến khi gặp frame thỏa predicate; hết thời gian thì raise TimeoutError."""
+    async def read():
+        while True:
+            frame = json.loads(await ws.recv())
+            if predicate(frame):
+                return frame
+    return await asyncio.wait_for(read(), timeout)
+
+
+def of_type(frame_type: str, **fields):
+    return lambda frame: frame.get("type") == frame_type and all(frame.get(k) == v for k, v in fields.items())
@@ -0,0 +1,110 @@
+# ./tests/conftest.py
+# Test nhiều process: mỗi test có một redis-server riêng và khởi động các worker uvicorn thật trỏ vào nó.
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_until(check, timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"{what} did not start in {timeout}s")
+
+
+class Worker:
+    def __init__(self, port: int, process: subprocess.Popen):
+        self.port = port
+        self.process = process
+
+    @property
+    def http(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def ws(self) -> str:
+        return f"ws://127.0.0.1:{self.port}"
+
+    def stop(self):
+        # Tắt bình thường (SIGTERM), các hàm shutdown của app được chạy
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(10)
+
+    def kill(self):
+        # Giả lập worker chết đột ngột: không dọn dẹp gì trong Redis
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait(10)
+
+
+@pytest.fixture
+def redis_port():
+    binary = shutil.which("redis-server")
+    if binary is None:
+        pytest.skip("redis-server is not installed")
+    port = free_port()
+    process = subprocess.Popen([binary, "--port", str(port), "--save", "", "--appendonly", "no"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _wait_until(lambda: socket.create_connection(("127.0.0.1", port), 0.5).close() or True, 10, "redis-server")
+        yield port
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+@pytest.fixture
+def local_redis(redis_port, monkeypatch):
+    """Trỏ redis_client của chính process test vào redis-server của test, cho test gọi thẳng các module.
+
+    Gọi `await local_redis.init_redis()` bên trong event loop của test.
+    """
+    import redis_client
+    monkeypatch.setattr(redis_client, "REDIS_HOST", "127.0.0.1")
+    monkeypatch.setattr(redis_client, "REDIS_PORT", redis_port)
+    monkeypatch.setattr(redis_client, "redis_client", None)
+    return redis_client
+
+
+@pytest.fixture
+def start_worker(redis_port):
+    """start_worker(port=None, **env) khởi động một worker uvicorn dùng chung redis-server của test."""
+    workers = []
+
+    def start(port: int = None, **env) -> Worker:
+        port = port or free_port()
+        environment = dict(os.environ, REDIS_HOST="127.0.0.1", REDIS_PORT=str(redis_port))
+        environment.update({key: str(value) for key, value in env.items()})
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+             "--log-level", "warning"],
+            cwd=BACKEND_DIR, env=environment)
+        worker = Worker(port, process)
+        workers.append(worker)
+        _wait_until(lambda: urllib.request.urlopen(f"{worker.http}/metrics", timeout=1).status == 200, 20,
+                    f"worker on port {port}")
+        return worker
+
+    yield start
+    for worker in workers:
+        worker.kill()
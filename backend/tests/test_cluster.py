@@ -0,0 +1,77 @@
+# ./tests/test_cluster.py
+# Fan-out và presence giữa các worker qua Redis pub/sub, với hai process uvicorn dùng chung một redis-server.
+import asyncio
+from chat_client import connect, send_text, wait_for, of_type
+
+FAST_PRESENCE = {"HEARTBEAT_INTERVAL": 0.5, "PRESENCE_TTL": 2, "PRESENCE_WINDOW": 0.05}
+
+
+def test_message_published_on_one_worker_reaches_socket_on_another(start_worker):
+    a, b = start_worker(), start_worker()
+
+    async def scenario():
+        alice = await connect(a, "alice", "lobby")
+        await wait_for(alice, of_type("history"))
+        bob = await connect(b, "bob", "lobby")
+        users = await wait_for(bob, of_type("users"))
+        assert set(users["users"]) == {"alice", "bob"}
+
+        await send_text(bob, "lobby", "hello from b")
+        message = await wait_for(alice, of_type("message"))
+        assert message["username"] == "bob"
+        assert message["content"] == {"text": "hello from b"}
+        assert message["id"]
+
+        await send_text(alice, "lobby", "hello from a")
+        message = await wait_for(bob, of_type("message", username="alice"))
+        assert message["content"] == {"text": "hello from a"}
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(scenario())
+
+
+def test_join_and_leave_notices_cross_workers(start_worker):
+    a, b = start_worker(**FAST_PRESENCE), start_worker(**FAST_PRESENCE)
+
+    async def scenario():
+        alice = await connect(a, "alice", "lobby")
+        await wait_for(alice, of_type("history"))
+        bob = await connect(b, "bob", "lobby")
+        await wait_for(alice, lambda f: f["type"] == "presence" and f["joined"] == ["bob"])
+        notice = await wait_for(alice, of_type("notification"))
+        assert "bob" in notice["content"] and "joined" in notice["content"]
+
+        # Kết nối thứ hai của bob trên worker khác không tạo thêm sự kiện "joined"
+        bob_again = await connect(a, "bob", "lobby")
+        await wait_for(bob_again, of_type("history"))
+        await bob.close()
+        await bob_again.close()
+        presence = await wait_for(alice, of_type("presence"))
+        assert presence["joined"] == [] and presence["left"] == ["bob"]
+        await alice.close()
+
+    asyncio.run(scenario())
+
+
+def test_users_of_killed_worker_expire_and_can_join_again(start_worker):
+    a, b = start_worker(**FAST_PRESENCE), start_worker(**FAST_PRESENCE)
+
+    async def scenario():
+        alice = await connect(a, "alice", "lobby")
+        await wait_for(alice, of_type("history"))
+        bob = await connect(b, "bob", "lobby")
+        await wait_for(alice, lambda f: f["type"] == "presence" and "bob" in f["joined"])
+
+        b.kill()  # không chạy disconnect, entry của bob trong Redis chỉ còn chờ hết hạn
+        presence = await wait_for(alice, lambda f: f["type"] == "presence" and "bob" in f["left"], timeout=10)
+        assert presence["joined"] == []
+
+        bob = await connect(a, "bob", "lobby")
+        users = await wait_for(bob, of_type("users"))
+        assert set(users["users"]) == {"alice", "bob"}
+        await wait_for(alice, lambda f: f["type"] == "presence" and "bob" in f["joined"])
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,36 @@
+# ./tests/test_connections.py
+# Nhiều tab cùng username trên một worker: /session/ trả lại cùng token, nhưng mỗi tab là một kết nối riêng.
+import asyncio
+from chat_client import connect, session_token, send_text, wait_for, of_type
+
+
+def test_two_tabs_with_same_username_both_receive(start_worker):
+    worker = start_worker()
+    assert session_token(worker, "alice") == session_token(worker, "alice")
+
+    async def scenario():
+        tab1 = await connect(worker, "alice", "lobby")
+        await wait_for(tab1, of_type("history"))
+        tab2 = await connect(worker, "alice", "lobby")
+        await wait_for(tab2, of_type("history"))
+        bob = await connect(worker, "bob", "lobby")
+        users = await wait_for(bob, of_type("users"))
+        assert sorted(users["users"]) == ["alice", "bob"]
+
+        await send_text(bob, "lobby", "to both tabs")
+        for tab in (tab1, tab2):
+            message = await wait_for(tab, of_type("message", username="bob"))
+            assert message["content"] == {"text": "to both tabs"}
+
+        # Đóng một tab: alice vẫn online, tab còn lại vẫn nhận tin
+        await tab1.close()
+        await send_text(bob, "lobby", "after close")
+        message = await wait_for(tab2, of_type("message", username="bob"))
+        assert message["content"] == {"text": "after close"}
+        await bob.send('{"type": "users"}')
+        users = await wait_for(bob, of_type("users"))
+        assert sorted(users["users"]) == ["alice", "bob"]
+        await tab2.close()
+        await bob.close()
+
+    asyncio.run(scenario())
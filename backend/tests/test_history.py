@@ -0,0 +1,49 @@
+# ./tests/test_history.py
+# Ghi lịch sử vào Redis Stream: ghi lại một lô (sau khi lượt trước đã chạy trong Redis nhưng mất kết quả)
+# không được tạo bản trùng.
+import asyncio
+import history
+from history import append_messages, next_message_id, stream_key
+from serialization import dumps
+
+
+def message(text: str):
+    message_id = next_message_id()
+    return message_id, dumps({"id": message_id, "type": "message", "content": {"text": text}})
+
+
+def test_retried_batch_does_not_duplicate_entries(local_redis, monkeypatch):
+    monkeypatch.setattr(history, "_append_script", None)
+
+    async def scenario():
+        await local_redis.init_redis()
+        redis = local_redis.get_redis()
+        entries = [message("one"), message("two")]
+        first = await append_messages("lobby", entries)
+        assert first == [entry_id for entry_id, _ in entries]
+
+        again = await append_messages("lobby", entries, retry=True)
+        assert again == first
+        assert await redis.xlen(stream_key("lobby")) == 2
+        await redis.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_retry_finds_entries_that_redis_had_to_renumber(local_redis, monkeypatch):
+    monkeypatch.setattr(history, "_append_script", None)
+
+    async def scenario():
+        await local_redis.init_redis()
+        redis = local_redis.get_redis()
+        late = message("late")  # id cấp trước, ghi sau: nhỏ hơn entry cuối nên Redis tự cấp id mới
+        await append_messages("lobby", [message("first")])
+        first = await append_messages("lobby", [late])
+        assert first[0] != late[0]
+
+        again = await append_messages("lobby", [late], retry=True)
+        assert again == first
+        assert await redis.xlen(stream_key("lobby")) == 2
+        await redis.aclose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+# ./tests/test_public_keys.py
+# Danh bạ publicKey theo version: client ở dưới `floor` (dấu xóa nó cần đã bị bỏ) nhận lại toàn bộ danh bạ,
+# client ở trên chỉ nhận phần thay đổi và các user đã rời.
+import asyncio
+import public_keys
+from public_keys import store_key, remove_key, fetch_keys
+
+
+def test_tombstone_cap_decides_between_full_and_delta_snapshots(local_redis, monkeypatch):
+    monkeypatch.setattr(public_keys, "PUBLIC_KEY_TOMBSTONES", 2)
+    monkeypatch.setattr(public_keys, "_scripts", {})
+
+    async def scenario():
+        await local_redis.init_redis()
+        for name in ("a", "b", "c", "d", "e"):
+            await store_key("lobby", name, f"key-{name}")
+        synced_early = (await fetch_keys("lobby"))["version"]
+        assert synced_early == 5
+
+        await remove_key("lobby", "a")  # version 6
+        await remove_key("lobby", "b")  # version 7
+        synced_late = (await fetch_keys("lobby", synced_early))["version"]
+        assert synced_late == 7
+        await remove_key("lobby", "c")  # version 8: quá 2 dấu xóa, bỏ dấu của "a", floor = 6
+        version, changed = await store_key("lobby", "d", "key-d2")
+        assert (version, changed) == (9, True)
+
+        # Dưới floor: không còn biết "a" đã rời, phải thay cả danh bạ
+        early = await fetch_keys("lobby", synced_early)
+        assert early["full"] is True
+        assert early["keys"] == {"d": "key-d2", "e": "key-e"}
+        assert early["removed"] == []
+
+        # Đúng floor và trên floor: chỉ phần thay đổi
+        at_floor = await fetch_keys("lobby", 6)
+        assert at_floor["full"] is False
+        assert sorted(at_floor["removed"]) == ["b", "c"]
+        late = await fetch_keys("lobby", synced_late)
+        assert late == {"roomId": "lobby", "version": 9, "full": False, "keys": {"d": "key-d2"}, "removed": ["c"]}
+
+        # Version lạ (lớn hơn version hiện tại) hoặc 0 thì luôn nhận toàn bộ
+        assert (await fetch_keys("lobby", 100))["full"] is True
+        assert (await fetch_keys("lobby", 0))["full"] is True
+        await local_redis.get_redis().aclose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+# ./tests/test_ratelimit.py
+# Giới hạn tốc độ tính theo frame: tin mã hóa là một frame chứa bản mã của mọi người nhận, lặp lại timestamp
+# không được miễn phí; frame điều khiển (getKeys, publicKey, users) dùng bucket riêng.
+import asyncio
+from datetime import datetime
+from chat_client import connect, send, send_text, wait_for, of_type
+
+ROOM = "7"
+TIGHT_LIMITS = {"RATE_USER": 0.01, "RATE_USER_BURST": 3, "RATE_CONTROL": 0.01, "RATE_CONTROL_BURST": 5}
+
+
+def test_every_message_frame_costs_a_token_and_control_frames_do_not(start_worker):
+    worker = start_worker(**TIGHT_LIMITS)
+
+    async def scenario():
+        alice = await connect(worker, "alice", ROOM)
+        await wait_for(alice, of_type("history"))
+        bob = await connect(worker, "bob", ROOM)
+        await wait_for(bob, of_type("history"))
+
+        # Frame điều khiển hết hạn mức riêng của chúng...
+        for _ in range(5):
+            await send(alice, {"type": "getKeys", "roomId": ROOM})
+            await wait_for(alice, of_type("keys"))
+        await send(alice, {"type": "getKeys", "roomId": ROOM})
+        await wait_for(alice, of_type("error", code="rate_limited"))
+
+        # ...nhưng không ăn vào hạn mức gửi tin. Một tin cho cả phòng là một frame
+        ciphertexts = {"bob": {"encryptedContent": "AAAA", "nonce": "BBBB"}}
+        await send(alice, {"type": "message", "content": {"ciphertexts": ciphertexts}, "roomId": ROOM,
+                           "timestamp": datetime.utcnow().isoformat()})
+        message = await wait_for(bob, of_type("message", username="alice"))
+        assert message["content"] == {"ciphertexts": ciphertexts}
+
+        # Lặp lại cùng timestamp không được miễn phí: burst 3 chỉ cho thêm hai frame
+        timestamp = datetime.utcnow().isoformat()
+        for text in ("two", "three", "four"):
+            await send_text(alice, ROOM, text, timestamp)
+        for text in ("two", "three"):
+            message = await wait_for(bob, of_type("message", username="alice"))
+            assert message["content"] == {"text": text}
+        await wait_for(alice, of_type("error", code="rate_limited"))
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,122 @@
+# ./tests/test_sharding.py
+# Chia phòng theo node: hai node thật dùng chung redis-server; thay đổi tập "nodes" trong Redis
+# thì client bị chuyển hướng sang node chủ mới (redirect + đóng 4001).
+import asyncio
+import time
+import pytest
+import redis
+import websockets
+from conftest import free_port
+from chat_client import connect, wait_for, of_type
+from manager import manager
+from sharding import HashRing, NODES_KEY, ShardCoordinator
+
+FAST_RING = {"SHARDING_ENABLED": 1, "NODE_HEARTBEAT": 0.5, "NODE_TTL": 30}
+FAKE_NODE = "ws://127.0.0.1:1"
+
+
+def room_where(predicate) -> str:
+    for i in range(1, 10000):
+        if predicate(str(i)):
+            return str(i)
+    raise AssertionError("no matching room")
+
+
+async def expect_redirect(ws, url: str, timeout: float = 5.0):
+    frame = await wait_for(ws, of_type("redirect"), timeout)
+    assert frame["url"] == url
+    with pytest.raises(websockets.ConnectionClosed) as closed:
+        await asyncio.wait_for(ws.recv(), timeout)
+    assert closed.value.rcvd.code == 4001
+    assert closed.value.rcvd.reason == "Room moved."
+
+
+@pytest.fixture
+def two_nodes(start_worker):
+    ports = free_port(), free_port()
+    urls = [f"ws://127.0.0.1:{port}" for port in ports]
+    nodes = [start_worker(port, NODE_URL=url, **FAST_RING) for port, url in zip(ports, urls)]
+    # Chờ cả hai node thấy nhau trong vòng hash
+    time.sleep(1.5)
+    return nodes, urls
+
+
+def test_connecting_to_non_owner_is_redirected(two_nodes):
+    (a, b), (url_a, url_b) = two_nodes
+    ring = HashRing([url_a, url_b])
+    room_b = room_where(lambda room: ring.owner(room) == url_b)
+
+    async def scenario():
+        ws = await connect(a, "alice", room_b)
+        await expect_redirect(ws, url_b)
+        ws = await connect(b, "alice", room_b)
+        await wait_for(ws, of_type("history"))
+        await ws.close()
+
+    asyncio.run(scenario())
+
+
+def test_new_node_in_ring_takes_over_rooms(two_nodes, redis_port):
+    (a, b), (url_a, url_b) = two_nodes
+    before = HashRing([url_a, url_b])
+    after = HashRing([url_a, url_b, FAKE_NODE])
+    moving = room_where(lambda room: before.owner(room) == url_b and after.owner(room) == FAKE_NODE)
+    staying = room_where(lambda room: before.owner(room) == url_b and after.owner(room) == url_b)
+
+    async def scenario():
+        moved = await connect(b, "alice", moving)
+        await wait_for(moved, of_type("history"))
+        kept = await connect(b, "bob", staying)
+        await wait_for(kept, of_type("history"))
+
+        # Node mới xuất hiện trong Redis (score theo đồng hồ của Redis); các node nhận ra ở nhịp heartbeat kế tiếp
+        client = redis.Redis(port=redis_port)
+        seconds, micros = client.time()
+        client.zadd(NODES_KEY, {FAKE_NODE: seconds * 1000 + micros // 1000})
+        await expect_redirect(moved, FAKE_NODE)
+
+        # Phòng vẫn thuộc node cũ thì kết nối giữ nguyên
+        await kept.send('{"type": "users"}')
+        await wait_for(kept, of_type("users"))
+        await kept.close()
+
+    asyncio.run(scenario())
+
+
+def test_stopped_node_leaves_ring_without_waiting_for_ttl(two_nodes):
+    (a, b), (url_a, url_b) = two_nodes
+    ring = HashRing([url_a, url_b])
+    room_b = room_where(lambda room: ring.owner(room) == url_b)
+
+    async def scenario():
+        ws = await connect(b, "alice", room_b)
+        await wait_for(ws, of_type("history"))
+        stopping = asyncio.get_running_loop().run_in_executor(None, b.stop)
+        # uvicorn đóng WebSocket trước khi chạy shutdown của app; client kết nối lại qua node còn lại
+        with pytest.raises(websockets.ConnectionClosed):
+            await wait_for(ws, lambda frame: False)
+        await stopping
+
+        # NODE_TTL là 30 giây: node còn lại phục vụ phòng ngay nhờ node dừng đã tự rời vòng hash
+        ws = await connect(a, "alice", room_b)
+        await wait_for(ws, of_type("history"))
+        await ws.close()
+
+    asyncio.run(scenario())
+
+
+def test_node_with_fast_clock_does_not_evict_others(local_redis, monkeypatch):
+    async def scenario():
+        await local_redis.init_redis()
+        fast = ShardCoordinator(manager, node_url="ws://fast:8000", enabled=True)
+        normal = ShardCoordinator(manager, node_url="ws://normal:8000", enabled=True)
+        await normal.refresh()
+        real_time = time.time
+        monkeypatch.setattr(time, "time", lambda: real_time() + 3600)  # đồng hồ node nhanh hơn NODE_TTL
+        await fast.refresh()
+        monkeypatch.setattr(time, "time", real_time)
+        await normal.refresh()
+        assert fast.ring.nodes == normal.ring.nodes == ["ws://fast:8000", "ws://normal:8000"]
+        await local_redis.get_redis().aclose()
+
+    asyncio.run(scenario())
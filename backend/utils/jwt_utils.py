@@ -4,11 +4,12 @@ from datetime import datetime, timedelta
 
 JWT_SECRET = os.getenv("JWT_SECRET", "supersecretkey")
 JWT_ALGORITHM = "HS256"
+JWT_TTL = timedelta(days=7)
 
 def create_jwt(username):
     payload = {
         "sub": username,
-        "exp": datetime.utcnow() + timedelta(days=7)
+        "exp": datetime.utcnow() + JWT_TTL
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
@@ -1,6 +1,6 @@
 // src/hooks/useChat.js
 import { useState, useEffect, useRef } from 'react';
-import { fetchMessages, connectWebSocket, sendWebSocketMessage, sendSticker, fetchSessionId, sendMessage as apiSendMessage } from '../services/api';
+import { fetchMessages, connectWebSocket, sendFrame, sendWebSocketMessage, sendSticker, fetchSessionId, sendMessage as apiSendMessage } from '../services/api';
 import nacl from 'tweetnacl';
 
 // Hàm chuyển Uint8Array thành base64 trong trình duyệt
@@ -10,6 +10,20 @@ const uint8ArrayToBase64 = (array) =>
   return btoa(binaryString);
 };
 
+const base64ToUint8Array = (text) => new Uint8Array(atob(text).split('').map(c => c.charCodeAt(0)));
+
+// Mở một bản mã nacl.box; khóa chung của box giống nhau ở hai phía nên người gửi cũng mở được bằng public key người nhận
+const openBox = (box, otherPublicKey, secretKey) =>
+{
+  const decrypted = nacl.box.open(
+    base64ToUint8Array(box.encryptedContent),
+    base64ToUint8Array(box.nonce),
+    base64ToUint8Array(otherPublicKey),
+    secretKey
+  );
+  return decrypted ? new TextDecoder().decode(decrypted) : null;
+};
+
 // Debounce function
 const debounce = (func, delay) =>
 {
@@ -21,12 +35,25 @@ const debounce = (func, delay) =>
   };
 };
 
-const useChat = (username, roomId) =>
+// Chuyển hướng giữa các node (chế độ chia phòng): chờ tăng dần giữa các lần, tối đa MAX_REDIRECT_HOPS lần liên tiếp;
+// kết nối giữ được quá REDIRECT_STABLE_MS thì đếm lại từ đầu
+const REDIRECT_BASE_DELAY_MS = 200;
+const REDIRECT_MAX_DELAY_MS = 5000;
+const MAX_REDIRECT_HOPS = 5;
+const REDIRECT_STABLE_MS = 10000;
+
+// protocol: 'json' | 'msgpack'; bỏ trống để dùng REACT_APP_WS_PROTOCOL
+const useChat = (username, roomId, { protocol } = {}) =>
 {
   const [messages, setMessages] = useState([]);
   const [onlineUsers, setOnlineUsers] = useState([]);
   const [notifications, setNotifications] = useState([]);
   const wsRef = useRef(null);
+  const lastSeenIdRef = useRef(null);
+  const keysVersionRef = useRef(0); // version danh bạ publicKey của phòng đã đồng bộ
+  const wsBaseRef = useRef(null); // địa chỉ node phục vụ phòng khi server chuyển hướng (chế độ chia phòng)
+  const redirectHopsRef = useRef(0); // số lần bị chuyển hướng liên tiếp
+  const openedAtRef = useRef(0); // thời điểm socket hiện tại mở
   const [keyPair, setKeyPair] = useState(null);
   const [publicKeys, setPublicKeys] = useState({});
   const [isSending, setIsSending] = useState(false);
@@ -37,6 +64,11 @@ const useChat = (username, roomId) =>
 
     const newKeyPair = nacl.box.keyPair();
     setKeyPair(newKeyPair);
+    lastSeenIdRef.current = null;
+    wsBaseRef.current = null;
+    redirectHopsRef.current = 0;
+    keysVersionRef.current = 0;
+    let active = true;
 
     const initializeSession = async () =>
     {
@@ -54,149 +86,260 @@ const useChat = (username, roomId) =>
         return;
       }
 
-      const socket = connectWebSocket(
-        username,
-        roomId,
-        (data) =>
-        {
-          if (data.type === 'message' || data.type === 'sticker')
+      // Mở WebSocket; khi mất kết nối thì mở lại và chỉ nhận bù các tin sau lastSeenId
+      const openSocket = () =>
+      {
+        const socket = connectWebSocket(
+          username,
+          roomId,
+          (data) =>
           {
-            let messageContent;
-            let isSticker = false;
-            let isEmoji = false;
-            if (data.content && data.content.encryptedContent && keyPair)
+            if (data.type === 'message' || data.type === 'sticker')
             {
-              // Giải mã bằng private key của mình
-              const theirPublicKey = publicKeys[data.username];
-              if (theirPublicKey)
-              {
-                const nonce = new Uint8Array(atob(data.content.nonce).split('').map(c => c.charCodeAt(0)));
-                const encryptedContent = new Uint8Array(atob(data.content.encryptedContent).split('').map(c => c.charCodeAt(0)));
-                const decrypted = nacl.box.open(
-                  encryptedContent,
-                  nonce,
-                  new Uint8Array(atob(theirPublicKey).split('').map(c => c.charCodeAt(0))),
-                  keyPair.secretKey
-                );
-                messageContent = decrypted ? new TextDecoder().decode(decrypted) : 'Tin nhắn mã hóa (không thể giải mã)';
-              } else
+              if (data.id) lastSeenIdRef.current = data.id;
+              let messageContent;
+              let isSticker = false;
+              let isEmoji = false;
+              if (data.content && data.content.ciphertexts && keyPair)
               {
-                messageContent = 'Tin nhắn mã hóa (thiếu khóa công khai)';
-              }
-            } else if (data.content && typeof data.content === 'object')
-            {
-              if (data.content.sticker_id)
+                // Một frame cho cả phòng, mỗi người nhận một bản mã; tin của chính mình thì mở bản của người nhận bất kỳ
+                const own = data.content.ciphertexts[username];
+                const [recipient, box] = own
+                  ? [data.username, own]
+                  : (data.username === username ? Object.entries(data.content.ciphertexts)[0] || [] : []);
+                const otherPublicKey = recipient && publicKeys[recipient];
+                if (!box)
+                {
+                  messageContent = 'Tin nhắn mã hóa (không gửi cho bạn)';
+                } else if (otherPublicKey)
+                {
+                  messageContent = openBox(box, otherPublicKey, keyPair.secretKey) || 'Tin nhắn mã hóa (không thể giải mã)';
+                } else
+                {
+                  messageContent = 'Tin nhắn mã hóa (thiếu khóa công khai)';
+                }
+              } else if (data.content && data.content.encryptedContent && keyPair)
               {
-                messageContent = `/stickers/${data.content.sticker_id}.jpg`;
-                isSticker = true;
-              } else if (data.content.emoji)
+                // Định dạng cũ: mỗi người nhận một frame riêng
+                // Giải mã bằng private key của mình
+                const theirPublicKey = publicKeys[data.username];
+                if (theirPublicKey)
+                {
+                  const nonce = new Uint8Array(atob(data.content.nonce).split('').map(c => c.charCodeAt(0)));
+                  const encryptedContent = new Uint8Array(atob(data.content.encryptedContent).split('').map(c => c.charCodeAt(0)));
+                  const decrypted = nacl.box.open(
+                    encryptedContent,
+                    nonce,
+                    new Uint8Array(atob(theirPublicKey).split('').map(c => c.charCodeAt(0))),
+                    keyPair.secretKey
+                  );
+                  messageContent = decrypted ? new TextDecoder().decode(decrypted) : 'Tin nhắn mã hóa (không thể giải mã)';
+                } else
+                {
+                  messageContent = 'Tin nhắn mã hóa (thiếu khóa công khai)';
+                }
+              } else if (data.content && typeof data.content === 'object')
               {
-                messageContent = data.content.emoji;
-                isEmoji = true;
-              } else if (data.content.text)
+                if (data.content.sticker_id)
+                {
+                  messageContent = `/stickers/${data.content.sticker_id}.jpg`;
+                  isSticker = true;
+                } else if (data.content.emoji)
+                {
+                  messageContent = data.content.emoji;
+                  isEmoji = true;
+                } else if (data.content.text)
+                {
+                  messageContent = data.content.text;
+                } else
+                {
+                  messageContent = 'Tin nhắn không xác định';
+                }
+              } else if (typeof data.content === 'string')
               {
-                messageContent = data.content.text;
+                messageContent = data.content;
               } else
               {
-                messageContent = 'Tin nhắn không xác định';
+                messageContent = 'Tin nhắn không hợp lệ';
               }
-            } else if (typeof data.content === 'string')
+              setMessages((prev) => [...prev, {
+                id: data.id,
+                username: data.username,
+                message: messageContent,
+                timestamp: data.timestamp,
+                isSticker,
+                isEmoji
+              }]);
+            } else if (data.type === 'users')
             {
-              messageContent = data.content;
-            } else
+              setOnlineUsers(data.users);
+            } else if (data.type === 'presence')
             {
-              messageContent = 'Tin nhắn không hợp lệ';
-            }
-            setMessages((prev) => [...prev, {
-              username: data.username,
-              message: messageContent,
-              timestamp: data.timestamp,
-              isSticker,
-              isEmoji
-            }]);
-          } else if (data.type === 'users')
-          {
-            setOnlineUsers(data.users);
-          } else if (data.type === 'notification')
-          {
-            const newNotification = { id: Date.now(), content: data.content };
-            setNotifications((prev) => [...prev, newNotification]);
-            setTimeout(() => setNotifications((prev) => prev.filter((n) => n.id !== newNotification.id)), 5000);
-          } else if (data.type === 'session')
-          {
-            localStorage.setItem('sessionId', data.sessionId);
-          } else if (data.type === 'publicKey')
-          {
-            setPublicKeys((prev) =>
+              // Chỉ nhận phần thay đổi so với danh sách online đã có
+              setOnlineUsers((prev) =>
+              {
+                const left = new Set(data.left);
+                const kept = prev.filter((u) => !left.has(u));
+                return [...kept, ...data.joined.filter((u) => !kept.includes(u))];
+              });
+            } else if (data.type === 'notification')
             {
-              const updatedKeys = { ...prev, [data.username]: data.publicKey };
-              // console.log('Updated publicKeys:', updatedKeys);
-              return updatedKeys;
-            });
-          } else if (data.type === 'history')
-          {
-            setMessages(data.messages.map(msg =>
+              const newNotification = { id: Date.now(), content: data.content };
+              setNotifications((prev) => [...prev, newNotification]);
+              setTimeout(() => setNotifications((prev) => prev.filter((n) => n.id !== newNotification.id)), 5000);
+            } else if (data.type === 'error' && data.code === 'rate_limited')
             {
-              let messageContent = '';
-              let isSticker = false;
-              let isEmoji = false;
-              if (msg.content && typeof msg.content === 'object')
+              // Server bỏ tin vì gửi quá nhanh
+              const newNotification = { id: Date.now(), content: 'Bạn gửi tin quá nhanh, vui lòng chờ một chút.' };
+              setNotifications((prev) => [...prev, newNotification]);
+              setTimeout(() => setNotifications((prev) => prev.filter((n) => n.id !== newNotification.id)), 5000);
+            } else if (data.type === 'redirect')
+            {
+              // Phòng do node khác phục vụ; server sẽ đóng socket này với lý do 'Room moved.'
+              wsBaseRef.current = data.url;
+            } else if (data.type === 'session')
+            {
+              localStorage.setItem('sessionId', data.sessionId);
+            } else if (data.type === 'publicKey')
+            {
+              setPublicKeys((prev) =>
               {
-                if (msg.content.sticker_id)
-                {
-                  messageContent = `/stickers/${msg.content.sticker_id}.jpg`;
-                  isSticker = true;
-                } else if (msg.content.emoji)
+                const updatedKeys = { ...prev, [data.username]: data.publicKey };
+                // console.log('Updated publicKeys:', updatedKeys);
+                return updatedKeys;
+              });
+            } else if (data.type === 'keys')
+            {
+              // Danh bạ publicKey của phòng: toàn bộ (full) hoặc chỉ phần thay đổi sau version đã có
+              keysVersionRef.current = data.version;
+              setPublicKeys((prev) =>
+              {
+                const updatedKeys = data.full ? { ...data.keys } : { ...prev, ...data.keys };
+                data.removed.forEach((u) => delete updatedKeys[u]);
+                return updatedKeys;
+              });
+            } else if (data.type === 'ids')
+            {
+              // Server lưu tin với id khác id đã gửi: sửa lại để replay và lọc trùng theo id vẫn đúng
+              if (data.ids[lastSeenIdRef.current]) lastSeenIdRef.current = data.ids[lastSeenIdRef.current];
+              setMessages((prev) => prev.map((m) => (data.ids[m.id] ? { ...m, id: data.ids[m.id] } : m)));
+            } else if (data.type === 'history' || data.type === 'replay')
+            {
+              if (data.messages.length > 0) lastSeenIdRef.current = data.messages[data.messages.length - 1].id;
+              const mapped = data.messages.map(msg =>
+              {
+                let messageContent = '';
+                let isSticker = false;
+                let isEmoji = false;
+                if (msg.content && typeof msg.content === 'object')
                 {
-                  messageContent = msg.content.emoji;
-                  isEmoji = true;
-                } else if (msg.content.text)
+                  if (msg.content.sticker_id)
+                  {
+                    messageContent = `/stickers/${msg.content.sticker_id}.jpg`;
+                    isSticker = true;
+                  } else if (msg.content.emoji)
+                  {
+                    messageContent = msg.content.emoji;
+                    isEmoji = true;
+                  } else if (msg.content.text)
+                  {
+                    messageContent = msg.content.text;
+                  } else
+                  {
+                    messageContent = 'Tin nhắn không xác định';
+                  }
+                } else if (typeof msg.content === 'string')
                 {
-                  messageContent = msg.content.text;
+                  messageContent = msg.content;
                 } else
                 {
-                  messageContent = 'Tin nhắn không xác định';
+                  messageContent = 'Tin nhắn không hợp lệ';
                 }
-              } else if (typeof msg.content === 'string')
+                return {
+                  id: msg.id,
+                  username: msg.username,
+                  message: messageContent,
+                  timestamp: msg.timestamp,
+                  isSticker,
+                  isEmoji
+                };
+              });
+              if (data.type === 'history')
               {
-                messageContent = msg.content;
+                setMessages(mapped);
               } else
               {
-                messageContent = 'Tin nhắn không hợp lệ';
+                // Replay sau khi kết nối lại: chỉ nối thêm các tin chưa có
+                setMessages((prev) =>
+                {
+                  const seen = new Set(prev.map((m) => m.id));
+                  return [...prev, ...mapped.filter((m) => !seen.has(m.id))];
+                });
               }
-              return {
-                username: msg.username,
-                message: messageContent,
-                timestamp: msg.timestamp,
-                isSticker,
-                isEmoji
-              };
-            }));
-          }
-        },
-        (error) =>
-        {
-          console.error('WebSocket error:', error);
-          setNotifications((prev) => [...prev, { id: Date.now(), content: 'Lỗi kết nối WebSocket.' }]);
-        },
-        (reason) =>
-        {
-          // Do nothing on disconnect, no notification
-        }
-      );
+            }
+          },
+          (error) =>
+          {
+            console.error('WebSocket error:', error);
+            setNotifications((prev) => [...prev, { id: Date.now(), content: 'Lỗi kết nối WebSocket.' }]);
+          },
+          (reason) =>
+          {
+            // Được chuyển sang node khác: kết nối lại tới node đó. Khi các node chưa thống nhất vòng hash,
+            // client có thể bị chuyển qua lại, nên chờ tăng dần và dừng sau MAX_REDIRECT_HOPS lần
+            if (active && reason === 'Room moved.')
+            {
+              if (Date.now() - openedAtRef.current > REDIRECT_STABLE_MS) redirectHopsRef.current = 0;
+              redirectHopsRef.current += 1;
+              let delay = Math.min(REDIRECT_BASE_DELAY_MS * 2 ** (redirectHopsRef.current - 1), REDIRECT_MAX_DELAY_MS);
+              if (redirectHopsRef.current > MAX_REDIRECT_HOPS)
+              {
+                // Quay về địa chỉ mặc định và thử lại sau, như khi mất kết nối
+                redirectHopsRef.current = 0;
+                wsBaseRef.current = null;
+                delay = REDIRECT_MAX_DELAY_MS;
+                setNotifications((prev) => [...prev, { id: Date.now(), content: 'Không kết nối được tới máy chủ của phòng, đang thử lại...' }]);
+              }
+              setTimeout(() =>
+              {
+                if (active) openSocket();
+              }, delay);
+              return;
+            }
+            // Không thông báo; chỉ tự kết nối lại khi mất kết nối ngoài ý muốn hoặc bị server ngắt vì không phản hồi ping
+            if (active && (reason === 'WebSocket disconnected unexpectedly.' || reason === 'Idle timeout.'))
+            {
+              // Node cũ có thể đã tắt, quay về địa chỉ mặc định để được chuyển hướng lại nếu cần
+              wsBaseRef.current = null;
+              setTimeout(() =>
+              {
+                if (active) openSocket();
+              }, 1000);
+            }
+          },
+          lastSeenIdRef.current,
+          protocol,
+          wsBaseRef.current
+        );
 
-      wsRef.current = socket;
+        wsRef.current = socket;
 
-      // Gửi publicKey chỉ khi WebSocket mở
-      socket.addEventListener('open', () =>
-      {
-        socket.send(JSON.stringify({
-          type: 'publicKey',
-          username,
-          publicKey: uint8ArrayToBase64(newKeyPair.publicKey),
-          roomId
-        }));
-      });
+        // Gửi publicKey chỉ khi WebSocket mở
+        socket.addEventListener('open', () =>
+        {
+          openedAtRef.current = Date.now();
+          sendFrame(socket, {
+            type: 'publicKey',
+            username,
+            publicKey: uint8ArrayToBase64(newKeyPair.publicKey),
+            roomId
+          });
+          // Lấy key của các thành viên khác trong một frame thay vì chờ từng người gửi lại
+          sendFrame(socket, { type: 'getKeys', since: keysVersionRef.current, roomId });
+        });
+      };
+
+      openSocket();
 
       return () =>
       {
@@ -258,13 +401,14 @@ const useChat = (username, roomId) =>
 
     return () =>
     {
+      active = false;
       if (wsRef.current)
       {
         wsRef.current.close();
         wsRef.current = null;
       }
     };
-  }, [username, roomId]);
+  }, [username, roomId, protocol]);
 
   const debouncedSendMessage = debounce((content, type) =>
   {
@@ -318,40 +462,29 @@ const useChat = (username, roomId) =>
       return;
     }
 
-    recipients.forEach(recipient =>
+    // Một frame cho mỗi tin: server tính giới hạn tốc độ theo frame và broadcast một lần cho cả phòng
+    if (type === 'message')
     {
-      const theirPublicKey = publicKeys[recipient]
-        ? new Uint8Array(atob(publicKeys[recipient]).split('').map(c => c.charCodeAt(0)))
-        : null;
-      let messageContent = content;
-      if (theirPublicKey && type === 'message')
+      const ciphertexts = {};
+      recipients.forEach(recipient =>
       {
         const nonce = nacl.randomBytes(nacl.box.nonceLength);
         const encrypted = nacl.box(
           new TextEncoder().encode(content),
           nonce,
-          theirPublicKey,
+          base64ToUint8Array(publicKeys[recipient]),
           keyPair.secretKey
         );
-        messageContent = {
+        ciphertexts[recipient] = {
           encryptedContent: uint8ArrayToBase64(encrypted),
           nonce: uint8ArrayToBase64(nonce)
         };
-        if (type === 'message')
-        {
-          sendWebSocketMessage(wsRef.current, messageContent, roomId, username);
-        }
-      } else if (type === 'sticker')
-      {
-        messageContent = content;
-        sendSticker(wsRef.current, messageContent, roomId, username);
-      }
-      // Nếu là message nhưng không có publicKey thì không gửi
-      if (type === 'message' && theirPublicKey)
-      {
-        // Đã gửi ở trên
-      }
-    });
+      });
+      sendWebSocketMessage(wsRef.current, { ciphertexts }, roomId, username);
+    } else if (type === 'sticker')
+    {
+      sendSticker(wsRef.current, content, roomId, username);
+    }
 
     setIsSending(false);
   }, 500);
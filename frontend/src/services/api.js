@@ -1,6 +1,9 @@
 // src/services/api.js
+import { encode, decode } from './msgpack';
 const API_BASE_URL = process.env.REACT_APP_API_BASE_URL || 'http://localhost';
 const WS_BASE_URL = process.env.REACT_APP_WS_BASE_URL || 'ws://localhost';
+// 'msgpack' để dùng frame nhị phân MessagePack thay cho JSON (server không hỗ trợ thì tự quay về JSON)
+const WS_PROTOCOL = process.env.REACT_APP_WS_PROTOCOL || 'json';
 
 const fetchSessionId = async (username) =>
 {
@@ -26,11 +29,16 @@ const fetchSessionId = async (username) =>
   }
 };
 
-const fetchMessages = async (roomId) =>
+// Lấy lịch sử theo trang: `before` là id của tin cũ nhất đang có, bỏ trống để lấy các tin mới nhất
+const fetchMessages = async (roomId, { before, limit } = {}) =>
 {
   try
   {
-    const response = await fetch(`${API_BASE_URL}/messages/${roomId}/`, {
+    const params = new URLSearchParams();
+    if (before !== undefined && before !== null) params.set('before', before);
+    if (limit) params.set('limit', limit);
+    const query = params.toString() ? `?${params.toString()}` : '';
+    const response = await fetch(`${API_BASE_URL}/messages/${roomId}/${query}`, {
       headers: {
         'Authorization': `Bearer ${localStorage.getItem('sessionId') || ''}`,
       },
@@ -41,6 +49,7 @@ const fetchMessages = async (roomId) =>
     }
     const data = await response.json();
     return data.map((msg) => ({
+      id: msg.id,
       username: msg.username,
       message: typeof msg.content === 'object' && msg.content.text ? msg.content.text : msg.content,
       timestamp: msg.timestamp,
@@ -96,12 +105,20 @@ const sendMessage = async (username, content, roomId, type = 'message') =>
   }
 };
 
-const connectWebSocket = (username, roomId, onMessageReceived, onWebSocketError, onWebSocketClose) =>
+// Gửi một frame theo giao thức đã thỏa thuận với server (ws.protocol do server chọn khi bắt tay)
+const sendFrame = (ws, payload) =>
+{
+  ws.send(ws.protocol === 'msgpack' ? encode(payload) : JSON.stringify(payload));
+};
+
+const connectWebSocket = (username, roomId, onMessageReceived, onWebSocketError, onWebSocketClose, lastSeenId = null, protocol = WS_PROTOCOL, baseUrl = null) =>
 {
   const sessionId = localStorage.getItem('sessionId') || '';
   const ws = new WebSocket(
-    `${WS_BASE_URL}/ws/chat/${username}?sessionId=${sessionId}${roomId ? `&roomId=${roomId}` : ''}`
+    `${baseUrl || WS_BASE_URL}/ws/chat/${username}?sessionId=${sessionId}${roomId ? `&roomId=${roomId}` : ''}${lastSeenId ? `&lastSeenId=${lastSeenId}` : ''}`,
+    protocol === 'msgpack' ? ['msgpack', 'json'] : undefined
   );
+  ws.binaryType = 'arraybuffer';
 
   ws.onopen = () =>
   {
@@ -111,7 +128,13 @@ const connectWebSocket = (username, roomId, onMessageReceived, onWebSocketError,
   {
     try
     {
-      const data = JSON.parse(event.data);
+      const data = typeof event.data === 'string' ? JSON.parse(event.data) : decode(event.data);
+      // Server ping định kỳ để phát hiện kết nối chết; trả lời ngay, không chuyển lên giao diện
+      if (data.type === 'ping')
+      {
+        sendFrame(ws, { type: 'pong' });
+        return;
+      }
       onMessageReceived(data);
     } catch (error)
     {
@@ -141,13 +164,13 @@ const sendWebSocketMessage = (ws, content, roomId, username) =>
 {
   if (ws && ws.readyState === WebSocket.OPEN)
   {
-    ws.send(JSON.stringify({
+    sendFrame(ws, {
       type: 'message',
       username,
       content,
       roomId,
       timestamp: new Date().toISOString(),
-    }));
+    });
   }
 };
 
@@ -155,14 +178,14 @@ const sendSticker = (ws, content, roomId, username) =>
 {
   if (ws && ws.readyState === WebSocket.OPEN)
   {
-    ws.send(JSON.stringify({
+    sendFrame(ws, {
       type: 'sticker',
       username,
       content,
       roomId,
       timestamp: new Date().toISOString(),
-    }));
+    });
   }
 };
 
-export { fetchMessages, sendMessage, connectWebSocket, sendWebSocketMessage, sendSticker, fetchSessionId };
\ No newline at end of file
+export { fetchMessages, sendMessage, connectWebSocket, sendFrame, sendWebSocketMessage, sendSticker, fetchSessionId };
\ No newline at end of file
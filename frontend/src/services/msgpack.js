@@ -0,0 +1,143 @@
+// src/services/msgpack.js
+// Bộ mã hóa/giải mã MessagePack tối giản cho giao thức WebSocket nhị phân:
+// chỉ hỗ trợ các kiểu mà tin nhắn chat dùng (null, bool, số, chuỗi, bytes, mảng, object).
+
+const textEncoder = new TextEncoder();
+const textDecoder = new TextDecoder();
+
+const encode = (value) =>
+{
+  const bytes = [];
+  const pushUint = (n, size) =>
+  {
+    for (let i = size - 1; i >= 0; i--) bytes.push((n / 2 ** (8 * i)) & 0xff);
+  };
+  const pushLength = (length, fix, fixMax, codes) =>
+  {
+    if (fix !== null && length <= fixMax) bytes.push(fix | length);
+    else if (codes[0] !== null && length < 0x100) { bytes.push(codes[0]); pushUint(length, 1); }
+    else if (length < 0x10000) { bytes.push(codes[1]); pushUint(length, 2); }
+    else { bytes.push(codes[2]); pushUint(length, 4); }
+  };
+  const write = (v) =>
+  {
+    if (v === null || v === undefined) bytes.push(0xc0);
+    else if (v === false) bytes.push(0xc2);
+    else if (v === true) bytes.push(0xc3);
+    else if (typeof v === 'number')
+    {
+      if (Number.isInteger(v) && v >= 0 && v < 0x100000000)
+      {
+        if (v < 0x80) bytes.push(v);
+        else if (v < 0x100) { bytes.push(0xcc); pushUint(v, 1); }
+        else if (v < 0x10000) { bytes.push(0xcd); pushUint(v, 2); }
+        else { bytes.push(0xce); pushUint(v, 4); }
+      } else if (Number.isInteger(v) && v < 0 && v >= -0x80000000)
+      {
+        if (v >= -32) bytes.push(v & 0xff);
+        else { bytes.push(0xd2); pushUint(v >>> 0, 4); }
+      } else
+      {
+        const view = new DataView(new ArrayBuffer(8));
+        view.setFloat64(0, v);
+        bytes.push(0xcb, ...new Uint8Array(view.buffer));
+      }
+    } else if (typeof v === 'string')
+    {
+      const data = textEncoder.encode(v);
+      pushLength(data.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+      for (const b of data) bytes.push(b);
+    } else if (v instanceof Uint8Array)
+    {
+      pushLength(v.length, null, 0, [0xc4, 0xc5, 0xc6]);
+      for (const b of v) bytes.push(b);
+    } else if (Array.isArray(v))
+    {
+      pushLength(v.length, 0x90, 15, [null, 0xdc, 0xdd]);
+      v.forEach(write);
+    } else
+    {
+      const entries = Object.entries(v).filter(([, item]) => item !== undefined);
+      pushLength(entries.length, 0x80, 15, [null, 0xde, 0xdf]);
+      entries.forEach(([key, item]) => { write(key); write(item); });
+    }
+  };
+  write(value);
+  return new Uint8Array(bytes);
+};
+
+const decode = (buffer) =>
+{
+  const data = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+  const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+  let offset = 0;
+  const uint = (size) =>
+  {
+    let n = 0;
+    for (let i = 0; i < size; i++) n = n * 256 + data[offset++];
+    return n;
+  };
+  const str = (length) =>
+  {
+    const value = textDecoder.decode(data.subarray(offset, offset + length));
+    offset += length;
+    return value;
+  };
+  const bin = (length) =>
+  {
+    const value = data.slice(offset, offset + length);
+    offset += length;
+    return value;
+  };
+  const array = (length) => Array.from({ length }, () => read());
+  const map = (length) =>
+  {
+    const result = {};
+    for (let i = 0; i < length; i++)
+    {
+      const key = read();
+      result[key] = read();
+    }
+    return result;
+  };
+  const read = () =>
+  {
+    const code = data[offset++];
+    if (code < 0x80) return code;
+    if (code < 0x90) return map(code & 0x0f);
+    if (code < 0xa0) return array(code & 0x0f);
+    if (code < 0xc0) return str(code & 0x1f);
+    if (code >= 0xe0) return code - 0x100;
+    let value;
+    switch (code)
+    {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: return bin(uint(1));
+      case 0xc5: return bin(uint(2));
+      case 0xc6: return bin(uint(4));
+      case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+      case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+      case 0xcc: return uint(1);
+      case 0xcd: return uint(2);
+      case 0xce: return uint(4);
+      case 0xcf: return uint(8);
+      case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+      case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+      case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+      case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+      case 0xd9: return str(uint(1));
+      case 0xda: return str(uint(2));
+      case 0xdb: return str(uint(4));
+      case 0xdc: return array(uint(2));
+      case 0xdd: return array(uint(4));
+      case 0xde: return map(uint(2));
+      case 0xdf: return map(uint(4));
+      default: throw new Error(`Unsupported MessagePack type 0x${code.toString(16)}`);
+    }
+  };
+  return read();
+};
+
+export { encode, decode };